@@ -35,6 +35,9 @@ from topsupergroupsbot import commands_private
 from topsupergroupsbot import digest_supergroups
 from topsupergroupsbot import cache_users_stats
 from topsupergroupsbot import cache_groups_rank
+from topsupergroupsbot import ingest_buffer
+from topsupergroupsbot import invalidation
+from topsupergroupsbot import partitions
 
 
 license = (
@@ -120,6 +123,8 @@ def main():
                                     pass_args=True))
     dp.add_handler(CommandHandler('bangroup', commands_private.ban_group, pass_args=True))
     dp.add_handler(CommandHandler('unbangroup', commands_private.unban_group, pass_args=True))
+    dp.add_handler(CommandHandler('statsperf', commands_private.stats_perf))
+    dp.add_handler(CommandHandler('rebuildrollups', commands_private.rebuild_rollups))
     # invalid command
     dp.add_handler(MessageHandler(Filters.command & Filters.private, utils.invalid_command))
     # handle all messages not command. it's obvious because commands are handled before, 
@@ -131,7 +136,14 @@ def main():
 
 
     # jobs
+    j.run_repeating(
+        ingest_buffer.flush_job,
+        interval=ingest_buffer.FLUSH_INTERVAL,
+        first=ingest_buffer.FLUSH_INTERVAL
+    )
     j.run_repeating(cleandb.clean_db, interval=60*60*24, first=0)
+    if config.PARTITIONING:
+        j.run_repeating(partitions.create_partitions_job, interval=60*60*24, first=60*60*24)
     j.run_repeating(memberslog.members_log, interval=60*60*24, first=0)
     j.run_daily(digest_private.weekly_own_private, time=datetime.time(0, 0, 0), days=(0,))
     j.run_daily(digest_supergroups.weekly_groups_digest, time=datetime.time(0, 0, 0), days=(0,))
@@ -147,6 +159,16 @@ def main():
         interval=leaderboards.MessagesLeaderboard.CACHE_SECONDS,
         first=0
     )
+    j.run_repeating(
+        leaderboards.scheduling_messages_24h_leaderboard_cache,
+        interval=leaderboards.Messages24hLeaderboard.CACHE_SECONDS,
+        first=0
+    )
+    j.run_repeating(
+        leaderboards.scheduling_messages_30d_leaderboard_cache,
+        interval=leaderboards.Messages30dLeaderboard.CACHE_SECONDS,
+        first=0
+    )
     j.run_repeating(
         leaderboards.scheduling_members_leaderboard_cache,
         interval=leaderboards.MembersLeaderboard.CACHE_SECONDS,
@@ -180,7 +202,7 @@ def main():
         days=(0,)
     )
     j.run_daily(
-        cache_users_stats.cache_users_stats,
+        cache_users_stats.rebuild_users_stats,
         time=datetime.time(0, 0, 0),
         days=(0,)
     )
@@ -192,9 +214,23 @@ def main():
     # handle errors
     dp.add_error_handler(error)
 
+    # migrate to partitioned tables if needed and create the next partitions
+    partitions.setup()
+    # the leaderboards of the regions are materialized views
+    leaderboards.create_views()
+
+    # keep in-process caches consistent with the other instances
+    invalidation.start()
+
     updater.start_polling()
     updater.idle()
 
+    # the updater is stopped: write what is still in memory
+    written, left = ingest_buffer.flush_before_exit()
+    print("flushed {} buffered messages before exiting".format(written))
+    if left > 0:
+        logger.error("%s buffered messages could not be written and are lost", left)
+
 
 if __name__ == '__main__':
     main()
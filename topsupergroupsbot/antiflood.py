@@ -17,84 +17,222 @@
 
 import time
 from topsupergroupsbot import database as db
+from topsupergroupsbot import ingest_buffer
+from topsupergroupsbot import live_leaderboard
+from topsupergroupsbot import cache_users_stats
+
+from telegram.ext.dispatcher import run_async
+
+
+FIXED = 'fixed'
+SLIDING = 'sliding'
+
+
+# Common part of the scripts.
+# KEYS[2]: list of "<msg_id>:<timestamp>" of the latest logged messages of
+#   the (group, user), so they can be retracted without searching them
+# ARGV: now, message id, then limit and interval of each window
+# When a window hits its limit for the first time the ids sent during the
+# window are returned too
+RECENT_MESSAGES_SCRIPT = """
+local now = tonumber(ARGV[1])
+local max_interval = 0
+local max_limit = 0
+for i = 3, #ARGV, 2 do
+    max_limit = math.max(max_limit, tonumber(ARGV[i]))
+    max_interval = math.max(max_interval, tonumber(ARGV[i+1]))
+end
+
+local function flood(position, value, limit, since)
+    local result = {position, value, tostring(since)}
+    if value == limit then
+        for _, item in ipairs(redis.call('LRANGE', KEYS[2], 0, limit - 2)) do
+            local sep = string.find(item, ':')
+            if tonumber(string.sub(item, sep + 1)) >= since then
+                table.insert(result, string.sub(item, 1, sep - 1))
+            end
+        end
+    end
+    return result
+end
+
+local function logged()
+    redis.call('LPUSH', KEYS[2], ARGV[2] .. ':' .. ARGV[1])
+    redis.call('LTRIM', KEYS[2], 0, max_limit - 1)
+    redis.call('EXPIRE', KEYS[2], math.ceil(max_interval))
+    return nil
+end
+"""
+
+# KEYS[1]: hash of the (group, user), for each window two fields:
+#   "c:<limit>:<interval>" the counter and "w:<limit>:<interval>" the number
+#   of the window the counter refers to (time // interval)
+# returns nil or {position of the window, counter, start of the window, ids...}
+FIXED_WINDOW_SCRIPT = RECENT_MESSAGES_SCRIPT + """
+redis.call('EXPIRE', KEYS[1], math.ceil(max_interval))
+
+for i = 3, #ARGV, 2 do
+    local limit = tonumber(ARGV[i])
+    local interval = tonumber(ARGV[i+1])
+    local suffix = ARGV[i] .. ':' .. ARGV[i+1]
+    local window = tostring(math.floor(now / interval))
+    if redis.call('HGET', KEYS[1], 'w:' .. suffix) ~= window then
+        redis.call('HSET', KEYS[1], 'w:' .. suffix, window)
+        redis.call('HSET', KEYS[1], 'c:' .. suffix, 0)
+    end
+    local value = redis.call('HINCRBY', KEYS[1], 'c:' .. suffix, 1)
+    if value > 1 and value >= limit then
+        return flood((i - 1) / 2, value, limit, tonumber(window) * interval)
+    end
+end
+return logged()
+"""
+
+# KEYS[1]: sorted set of the (group, user) with the timestamps of the messages
+# returns nil or {position of the window, counter, start of the window, ids...}
+SLIDING_WINDOW_SCRIPT = RECENT_MESSAGES_SCRIPT + """
+redis.call('ZADD', KEYS[1], now, ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. (now - max_interval))
+redis.call('EXPIRE', KEYS[1], math.ceil(max_interval))
+
+for i = 3, #ARGV, 2 do
+    local limit = tonumber(ARGV[i])
+    local interval = tonumber(ARGV[i+1])
+    local value = redis.call('ZCOUNT', KEYS[1], '(' .. (now - interval), '+inf')
+    if value > 1 and value >= limit then
+        return flood((i - 1) / 2, value, limit, now - interval)
+    end
+end
+return logged()
+"""
+
+_fixed_window = db.REDIS.register_script(FIXED_WINDOW_SCRIPT)
+_sliding_window = db.REDIS.register_script(SLIDING_WINDOW_SCRIPT)
+
+_stats = {
+    'flood_hits': 0,
+    'retracted_from_db': 0,
+    'retracted_from_buffer': 0
+}
 
 
 class Antiflood:
-    def __init__(self, limit, interval, group_id, user_id):
-        self.limit = limit
-        self.interval = interval
+    def __init__(self, checks, group_id, user_id, msg_id, mode=FIXED):
+        """
+        `checks` is a dict of maximum allowed messages (key) in seconds
+        interval (value), like config.FLOOD_CHECKS.
+        """
+        self.checks = list(checks.items())
         self.group_id = group_id
         self.user_id = user_id
+        self.msg_id = msg_id
+        self.mode = mode
         self.flood_key = self.flood_key()
+        # set by is_flood
+        self.limit = None
+        self.interval = None
 
     def flood_key(self):
         """
-        return a redis key to store the amount of sent messages
-        during the interval. The key is unique during the interval.
-        """
-        key = "af:{}:{}:{}:{}:{}".format(
-                self.group_id, 
-                self.user_id, 
-                (time.time()//self.interval),
-                self.interval,
-                self.limit)
-        return key
-
-    def expire_key(self):
-        """set a time for redis key expiration"""
-        db.REDIS.expire(self.flood_key, self.interval)
-
-    def get_time_key_started(self):
+        return the redis key storing the counters of all the windows
+        of the user in the group
         """
-        return the lower value of the interval of time
-        when the key has been created.
-        """
-        return float(self.flood_key.split(":")[3])*self.interval
+        prefix = "af" if self.mode == FIXED else "afs"
+        return "{}:{}:{}".format(prefix, self.group_id, self.user_id)
 
-    def del_messages_from_db(self):
-        """
-        Delete from the database all the messages sent during
-        the interval of the key
-        """
-        query = """
-            DELETE FROM messages 
-            WHERE (msg_id, group_id) IN (
-                SELECT msg_id, group_id 
-                FROM messages
-                WHERE 
-                    user_id = %s 
-                    AND group_id = %s
-                    AND message_date >= to_timestamp(%s)
-                ORDER BY message_date DESC
-                LIMIT %s
-            )
-        """
-        db.query_w(
-                query, 
-                self.user_id, 
-                self.group_id,
-                self.get_time_key_started(),
-                (self.limit-1))
+    def recent_messages_key(self):
+        return "afm:{}:{}".format(self.group_id, self.user_id)
+
+    def run_script(self):
+        args = [time.time(), self.msg_id]
+        for limit, interval in self.checks:
+            args.extend([limit, interval])
+        script = _fixed_window if self.mode == FIXED else _sliding_window
+        return script(keys=[self.flood_key, self.recent_messages_key()], args=args)
 
     def is_flood(self):
         """
-        return True if the user is flooding.
-        If there is not a key, it sets the key and the expiration time.
-        If the user hit the limit, delete messages sent during the interval
-        from the db.
+        return True if the user is flooding in any of the windows.
+        The first time a window hits its limit, messages sent during
+        the window are retracted from the db.
         """
-        value = db.REDIS.incr(self.flood_key, amount=1)
-
-        if value == 1:
-            # the key has been created now
-            self.expire_key()
+        result = self.run_script()
+        if result is None:
             return False
 
-        elif value == self.limit:
-            self.del_messages_from_db()
-            print("flood hit in {}".format(self.flood_key))
-            return True
+        position, value = result[0], result[1]
+        self.limit, self.interval = self.checks[int(position) - 1]
+        if value == self.limit:
+            _stats['flood_hits'] += 1
+            msg_ids = [int(i) for i in result[3:]]
+            retract_messages(self.group_id, self.user_id, msg_ids)
+            print("flood hit in {} ({} messages in {} seconds)".format(
+                    self.flood_key, self.limit, self.interval))
+        return True
+
+
+@run_async
+def retract_messages(group_id, user_id, msg_ids):
+    """
+    remove the messages of the user from the buffer if they are still
+    there, otherwise delete them by primary key
+    """
+    if len(msg_ids) == 0:
+        return
+    unflushed = ingest_buffer.discard(group_id, msg_ids)
+    to_delete = [i for i in msg_ids if i not in unflushed]
+    _stats['retracted_from_buffer'] += len(unflushed)
+    if len(to_delete) == 0:
+        return
+    # rollups are decremented in the same statement
+    query = """
+        WITH deleted AS (
+            DELETE FROM messages
+            WHERE group_id = %s AND msg_id = ANY(%s)
+            RETURNING msg_id, group_id, user_id, message_date
+        ), by_user AS (
+            SELECT date_trunc('week', message_date)::date AS week, group_id, user_id, COUNT(msg_id) AS amount
+            FROM deleted
+            GROUP BY 1, 2, 3
+        ), users_updated AS (
+            UPDATE user_week_counts AS u
+            SET amount = u.amount - w.amount
+            FROM by_user AS w
+            WHERE u.week = w.week AND u.group_id = w.group_id AND u.user_id = w.user_id
+        ), hours_updated AS (
+            UPDATE group_hour_counts AS h
+            SET amount = h.amount - w.amount
+            FROM (
+                SELECT date_trunc('hour', message_date) AS hour, group_id, COUNT(msg_id) AS amount
+                FROM deleted
+                GROUP BY 1, 2
+            ) AS w
+            WHERE h.hour = w.hour AND h.group_id = w.group_id
+        ), weeks_updated AS (
+            UPDATE group_week_counts AS g
+            SET amount = g.amount - w.amount
+            FROM (
+                SELECT week, group_id, SUM(amount)::int AS amount
+                FROM by_user
+                GROUP BY 1, 2
+            ) AS w
+            WHERE g.week = w.week AND g.group_id = w.group_id
+            RETURNING w.week, w.group_id, w.amount
+        )
+        -- one row at least, with the deleted messages, even if no week changed
+        SELECT (SELECT COUNT(*) FROM deleted), w.week, w.group_id, w.amount
+        FROM (SELECT 1) AS one
+        LEFT OUTER JOIN weeks_updated AS w
+        ON TRUE
+    """
+    deleted = db.query_wr(query, group_id, to_delete)
+    _stats['retracted_from_db'] += deleted[0][0]
+    live_leaderboard.add_counts([
+            (week, group_id, -amount)
+            for _, week, group_id, amount in deleted
+            if week is not None])
+    cache_users_stats.mark_dirty([user_id])
+
 
-        elif value > self.limit:
-            return True
-    
+def stats():
+    return dict(_stats)
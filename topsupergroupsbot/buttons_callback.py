@@ -26,6 +26,8 @@ from topsupergroupsbot import leaderboards
 from topsupergroupsbot import get_lang
 from topsupergroupsbot import constants as c
 from topsupergroupsbot import config
+from topsupergroupsbot import group_settings
+from topsupergroupsbot import user_profile
 
 from telegram import ParseMode
 from telegram.error import (TelegramError,
@@ -219,27 +221,26 @@ def filter_by_category(bot, query):
 
 @utils.creator_button_only
 def change_group_category(bot, query):
-    query_db = "SELECT lang, category FROM supergroups WHERE group_id = %s"
-    lang = database.query_r(query_db, query.message.chat.id, one=True)[0]
+    lang = group_settings.get_lang(query.message.chat.id)
     category = query.data.split(":")[1]
     query.answer()
     reply_markup = keyboards.group_categories_kb(lang, category)
     try:
         query_db = "UPDATE supergroups SET category = %s WHERE group_id = %s"
         database.query_w(query_db, category, query.message.chat.id)
+        group_settings.invalidate(query.message.chat.id)
         query.message.edit_reply_markup(reply_markup=reply_markup)
     except TelegramError as e:
         if str(e) != "Message is not modified": print(e) 
 
 @utils.creator_button_only
 def set_group_category(bot, query):
-    query_db = "SELECT lang, category FROM supergroups WHERE group_id = %s"
-    extract = database.query_r(query_db, query.message.chat.id, one=True)
-    if extract is None:
+    settings = group_settings.get(query.message.chat.id)
+    if settings is None:
         lang = None
         current_category = None
     else:
-        lang, current_category = extract
+        lang, current_category = settings.lang, settings.category
     text = get_lang.get_string(lang, "choose_group_category") 
     query.answer()
     reply_markup = keyboards.group_categories_kb(lang, current_category)
@@ -301,6 +302,7 @@ def choose_lang(bot, query):
     query.answer()
     query_db = "UPDATE supergroups SET lang = %s WHERE group_id = %s"
     database.query_w(query_db, lang, query.message.chat.id)
+    group_settings.invalidate(query.message.chat.id)
     try:
         query.edit_message_text(text=text, reply_markup=reply_markup)
     except TelegramError as e:
@@ -308,8 +310,7 @@ def choose_lang(bot, query):
 
 
 def main_group_settings(bot, query):
-    query_db = "SELECT lang FROM supergroups WHERE group_id = %s"
-    lang = database.query_r(query_db, query.message.chat.id, one=True)[0]
+    lang = group_settings.get_lang(query.message.chat.id)
     text = get_lang.get_string(lang, "group_settings")
     reply_markup = keyboards.main_group_settings_kb(lang)
     query.answer()
@@ -331,8 +332,7 @@ def main_group_settings_admin(bot, query):
 
 @utils.creator_button_only
 def group_lang_button(bot, query):
-    query_db = "SELECT lang FROM supergroups WHERE group_id = %s"
-    lang = database.query_r(query_db, query.message.chat.id, one=True)[0]
+    lang = group_settings.get_lang(query.message.chat.id)
     text = get_lang.get_string(lang, "choose_group_lang")
     reply_markup = keyboards.select_group_lang_kb(lang)
     query.answer()
@@ -344,10 +344,9 @@ def group_lang_button(bot, query):
 
 @utils.creator_button_only
 def adult_menu(bot, query):
-    query_db = "SELECT lang, nsfw FROM supergroups WHERE group_id = %s"
-    extraction = database.query_r(query_db, query.message.chat.id, one=True)
-    lang = extraction[0]
-    nsfw = extraction[1]
+    settings = group_settings.get(query.message.chat.id)
+    lang = settings.lang
+    nsfw = settings.nsfw
     text = get_lang.get_string(lang, "have_adult")
     reply_markup = keyboards.adult_content_kb(lang, nsfw)
     query.answer()
@@ -363,6 +362,7 @@ def set_adult(bot, query):
     final_value = True if value == "true" else False
     query_db = "UPDATE supergroups SET nsfw = %s WHERE group_id = %s RETURNING lang"
     extract = database.query_wr(query_db, final_value, query.message.chat.id, one=True)
+    group_settings.invalidate(query.message.chat.id)
     lang = extract[0]
     query.answer()
     text = get_lang.get_string(lang, "have_adult")
@@ -376,9 +376,7 @@ def set_adult(bot, query):
 @utils.admin_button_only
 def vote_link(bot, query):
     group_id = query.message.chat.id
-    query_db = "SELECT lang FROM supergroups WHERE group_id = %s"
-    extraction = database.query_r(query_db, group_id, one=True)
-    lang = extraction[0]
+    lang = group_settings.get_lang(group_id)
     text = get_lang.get_string(lang, "here_group_vote_link")
     text += "\n\n{}".format(votelink.create_vote_link(group_id))
     reply_markup = keyboards.vote_link_kb(lang)
@@ -392,10 +390,9 @@ def vote_link(bot, query):
 @utils.creator_button_only
 def group_digest_menu(bot, query):
     group_id = query.message.chat.id
-    query_db = "SELECT lang, weekly_digest FROM supergroups WHERE group_id = %s"
-    extract = database.query_r(query_db, group_id, one=True)
-    lang = extract[0]
-    weekly_digest = extract[1]
+    settings = group_settings.get(group_id)
+    lang = settings.lang
+    weekly_digest = settings.weekly_digest
     text = get_lang.get_string(lang, "group_weekly_digest")
     reply_markup = keyboards.weekly_group_digest_kb(lang, weekly_digest)
     if query.data.endswith("new_msg"):
@@ -416,6 +413,7 @@ def set_weekly_group_digest(bot, query):
     value = True if query.data.split(":")[1] == "true" else False
     query_db = "UPDATE supergroups SET weekly_digest = %s WHERE group_id = %s RETURNING lang"
     extract = database.query_wr(query_db, value, query.message.chat.id)
+    group_settings.invalidate(query.message.chat.id)
     lang = extract[0][0]
     reply_markup = keyboards.weekly_group_digest_kb(lang, value)
     query.answer()
@@ -445,28 +443,9 @@ def set_vote(bot, query):
             if str(e) != "Message is not modified": print(e)
         return
     vote = int(vote)
-    alert = ""
-    query_db = """
-    INSERT INTO votes 
-    (user_id, group_id, vote, vote_date) 
-    VALUES (%s, %s, %s, now())
-    ON CONFLICT DO NOTHING
-    RETURNING*
-    """
-    extract = database.query_wr(query_db, query.from_user.id, group_id, vote, one=True)
-    if extract is not None:
+    if write_vote(query.from_user.id, group_id, vote):
         alert = get_lang.get_string(lang, "registered_vote")
     else:
-        query_db = """
-        UPDATE votes 
-        SET 
-            vote = %s, 
-            vote_date = now() 
-        WHERE 
-            user_id = %s AND 
-            group_id = %s
-        """
-        database.query_w(query_db, vote, query.from_user.id, group_id)
         alert = get_lang.get_string(lang, "updated_vote")
     query.answer(text=alert, show_alert=True)
     text = "{}\n\n{}\n{}".format(utils.vote_intro(group_id, lang), alert, emojis.STAR * vote)
@@ -476,6 +455,67 @@ def set_vote(bot, query):
         if str(e) != "Message is not modified": print(e)
 
 
+def write_vote(user_id, group_id, vote):
+    """
+    insert or change the vote, and apply the difference to the
+    group_vote_stats of the group in the same transaction.
+    Returns True if it's the first vote of the user for the group
+    """
+    with database.transaction() as cursor:
+        insert_query = """
+        INSERT INTO votes 
+        (user_id, group_id, vote, vote_date) 
+        VALUES (%s, %s, %s, now())
+        ON CONFLICT DO NOTHING
+        RETURNING vote
+        """
+        cursor.execute(insert_query, (user_id, group_id, vote))
+        first_vote = cursor.fetchone() is not None
+        if first_vote:
+            difference, added = vote, 1
+        else:
+            # the old vote is read locking the row, so two changes of the
+            # same vote can't both subtract the same old value
+            query_db = """
+            UPDATE votes 
+            SET 
+                vote = %s, 
+                vote_date = now() 
+            FROM (
+                SELECT vote 
+                FROM votes 
+                WHERE user_id = %s AND group_id = %s 
+                FOR UPDATE
+            ) AS old
+            WHERE 
+                votes.user_id = %s AND 
+                votes.group_id = %s
+            RETURNING old.vote
+            """
+            cursor.execute(query_db, (vote, user_id, group_id, user_id, group_id))
+            old = cursor.fetchone()
+            if old is not None:
+                difference, added = vote - old[0], 0
+            else:
+                # the vote has been deleted after the insert conflicted:
+                # it's written as a new one. If it conflicts again the
+                # vote written meanwhile is kept and counted by its writer
+                cursor.execute(insert_query, (user_id, group_id, vote))
+                first_vote = cursor.fetchone() is not None
+                difference, added = (vote, 1) if first_vote else (0, 0)
+
+        query_db = """
+        INSERT INTO group_vote_stats AS g (group_id, votes_sum, votes_count)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (group_id) DO
+        UPDATE SET 
+            votes_sum = g.votes_sum + EXCLUDED.votes_sum, 
+            votes_count = g.votes_count + EXCLUDED.votes_count
+        """
+        cursor.execute(query_db, (group_id, difference, added))
+    return first_vote
+
+
 def current_page(bot, query):
     lang = utils.get_db_lang(query.from_user.id)
     query.answer(get_lang.get_string(lang, "already_this_page"), show_alert=True)
@@ -484,9 +524,7 @@ def current_page(bot, query):
 @utils.admin_button_only
 def current_page_admin(bot, query):
     group_id = query.message.chat.id
-    query_db = "SELECT lang FROM supergroups WHERE group_id = %s"
-    extract = database.query_r(query_db, group_id, one=True)
-    lang = extract[0] if extract is not None else None
+    lang = group_settings.get_lang(group_id)
     query.answer(get_lang.get_string(lang, "already_this_page"), show_alert=True)
 
 
@@ -506,6 +544,8 @@ def lbpage(bot, query):
     elif lb_type in [
         leaderboards.Leaderboard.VOTES,
         leaderboards.Leaderboard.MESSAGES,
+        leaderboards.Leaderboard.MESSAGES_24H,
+        leaderboards.Leaderboard.MESSAGES_30D,
         leaderboards.Leaderboard.MEMBERS
     ]:
         lbpage_private(bot, query, lb_type, page, region, category)
@@ -536,9 +576,7 @@ def lbpage_igl_private(bot, query, page, group_id_buttons):
 @utils.admin_button_only
 def lbpage_igl_group(bot, query, page, group_id_buttons):
     group_id = query.message.chat.id
-    query_db = "SELECT lang FROM supergroups WHERE group_id = %s"
-    extract = database.query_r(query_db, group_id, one=True)
-    lang = extract[0]
+    lang = group_settings.get_lang(group_id)
     leaderboard = leaderboards.GroupLeaderboard(lang=lang, page=int(page), group_id=group_id_buttons)
     result = leaderboard.build_page(group_username=query.message.chat.username)
     try:
@@ -555,6 +593,10 @@ def lbpage_private(bot, query, lb_type, page, region, category):
         leaderboard = leaderboards.VotesLeaderboard(lang, region, int(page), category)
     elif lb_type == leaderboards.Leaderboard.MESSAGES:
         leaderboard = leaderboards.MessagesLeaderboard(lang, region, int(page), category)
+    elif lb_type == leaderboards.Leaderboard.MESSAGES_24H:
+        leaderboard = leaderboards.Messages24hLeaderboard(lang, region, int(page), category)
+    elif lb_type == leaderboards.Leaderboard.MESSAGES_30D:
+        leaderboard = leaderboards.Messages30dLeaderboard(lang, region, int(page), category)
     elif lb_type == leaderboards.Leaderboard.MEMBERS:
         leaderboard = leaderboards.MembersLeaderboard(lang, region, int(page), category)
     result = leaderboard.build_page()
@@ -568,8 +610,9 @@ def lbpage_private(bot, query, lb_type, page, region, category):
 
 def set_private_lang(bot, query):
     lang = query.data.replace("set_private_lang_", "")
-    query_db = "UPDATE users SET lang = %s WHERE user_id = %s"
-    database.query_w(query_db, lang, query.from_user.id)
+    query_db = "UPDATE users SET lang = %s WHERE user_id = %s RETURNING {}".format(user_profile.COLUMNS)
+    extract = database.query_wr(query_db, lang, query.from_user.id, one=True)
+    user_profile.update(query.from_user.id, extract)
     query.answer()
     try:
         query.message.edit_reply_markup(reply_markup=keyboards.private_language_kb(lang))
@@ -584,9 +627,9 @@ def set_private_lang(bot, query):
 
 def set_private_region(bot, query):
     region = query.data.split(":")[1]
-    query_db = "UPDATE users SET region = %s WHERE user_id = %s RETURNING lang"
+    query_db = "UPDATE users SET region = %s WHERE user_id = %s RETURNING {}".format(user_profile.COLUMNS)
     extract = database.query_wr(query_db, region, query.from_user.id, one=True)
-    lang = extract[0]
+    lang = user_profile.update(query.from_user.id, extract).lang
     query.answer()
     try:
         query.message.edit_reply_markup(reply_markup=keyboards.private_region_kb(lang, region))
@@ -606,10 +649,9 @@ def main_private_settings(bot, query):
 
 def private_region(bot, query):
     query.answer()
-    query_db = "SELECT lang, region FROM users WHERE user_id = %s"
-    extract = database.query_r(query_db, query.from_user.id, one=True)
-    lang = extract[0]
-    region = extract[1]
+    profile = user_profile.get(query.from_user.id)
+    lang = profile.lang
+    region = profile.region
     text = get_lang.get_string(lang, "choose_region")
     reply_markup = keyboards.private_region_kb(lang, region)
     try:
@@ -620,9 +662,7 @@ def private_region(bot, query):
 
 def private_lang(bot, query):
     query.answer()
-    query_db = "SELECT lang FROM users WHERE user_id = %s"
-    extract = database.query_r(query_db, query.from_user.id, one=True)
-    lang = extract[0]
+    lang = utils.get_db_lang(query.from_user.id)
     text = get_lang.get_string(lang, "choose_your_lang")
     reply_markup = keyboards.private_language_kb(lang)
     try:
@@ -643,10 +683,9 @@ def private_digest(bot, query):
 
 
 def private_your_own_digest(bot, query):
-    query_db = "SELECT lang, weekly_own_digest FROM users WHERE user_id = %s"
-    extract = database.query_r(query_db, query.from_user.id, one=True)
-    lang = extract[0]
-    weekly_own_digest = extract[1]
+    profile = user_profile.get(query.from_user.id)
+    lang = profile.lang
+    weekly_own_digest = profile.weekly_own_digest
     text = get_lang.get_string(lang, "weekly_own_digest")
     reply_markup = keyboards.weekly_own_digest_kb(lang, weekly_own_digest)
     if query.data.endswith("new_msg"):
@@ -669,9 +708,9 @@ def private_groups_digest(bot, query):
 
 def set_weekly_own_digest(bot, query):
     value = True if query.data.split(":")[1] == "true" else False
-    query_db = "UPDATE users SET weekly_own_digest = %s WHERE user_id = %s RETURNING lang"
-    extract = database.query_wr(query_db, value, query.from_user.id)
-    lang = extract[0][0]
+    query_db = "UPDATE users SET weekly_own_digest = %s WHERE user_id = %s RETURNING {}".format(user_profile.COLUMNS)
+    extract = database.query_wr(query_db, value, query.from_user.id, one=True)
+    lang = user_profile.update(query.from_user.id, extract).lang
     reply_markup = keyboards.weekly_own_digest_kb(lang, value)
     query.answer()
     try:
@@ -690,6 +729,8 @@ def redirect_ledearboard(bot, query):
     if lb_type in [
         leaderboards.Leaderboard.VOTES,
         leaderboards.Leaderboard.MESSAGES,
+        leaderboards.Leaderboard.MESSAGES_24H,
+        leaderboards.Leaderboard.MESSAGES_30D,
         leaderboards.Leaderboard.MEMBERS
     ]:
         lbpage_private(bot, query, lb_type, 1, region, category)
@@ -0,0 +1,79 @@
+# TopSupergroupsBot - A telegram bot for telegram public groups leaderboards
+# Copyright (C) 2017-2018  Dario <dariomsn@hotmail.it> (github.com/91DarioDev)
+#
+# TopSupergroupsBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# TopSupergroupsBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TopSupergroupsBot.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import uuid
+
+from topsupergroupsbot import database
+
+
+# Caches are written in a fresh generation key, out of any transaction,
+# then RENAMEd over the key read by the bot in one MULTI/EXEC: readers
+# see the old data or the new one, never a mix, and stale fields go
+# away with the old key without diffing it.
+
+# fields or items sent by each HMSET/RPUSH
+CHUNK_SIZE = 1000
+
+
+def generation_key(key):
+    # unique, so two instances publishing together don't mix their data
+    return '{}:gen:{}'.format(key, uuid.uuid4().hex)
+
+
+def swap(gen_key, key, seconds, on_swap=None):
+    """
+    rename gen_key over key, or delete key if gen_key is None (nothing
+    to publish). `on_swap(pipe)` can add more commands to run in the
+    same transaction
+    """
+    pipe = database.REDIS.pipeline()
+    if gen_key is None:
+        pipe.delete(key)
+    else:
+        pipe.rename(gen_key, key)
+        pipe.expire(key, seconds)
+    if on_swap is not None:
+        on_swap(pipe)
+    pipe.execute()
+
+
+def publish_hash(key, mapping, seconds, on_swap=None):
+    """replace the hash in key with the dict mapping"""
+    items = list(mapping.items())
+    gen_key = None
+    if len(items) > 0:  # an empty hash doesn't exist in redis
+        gen_key = generation_key(key)
+        pipe = database.REDIS.pipeline(transaction=False)
+        for i in range(0, len(items), CHUNK_SIZE):
+            pipe.hmset(gen_key, dict(items[i:i+CHUNK_SIZE]))
+        # not left behind if the swap never happens
+        pipe.expire(gen_key, seconds)
+        pipe.execute()
+    swap(gen_key, key, seconds, on_swap)
+
+
+def publish_list(key, items, seconds, on_swap=None):
+    """replace the list in key with items"""
+    gen_key = None
+    if len(items) > 0:
+        gen_key = generation_key(key)
+        pipe = database.REDIS.pipeline(transaction=False)
+        for i in range(0, len(items), CHUNK_SIZE):
+            pipe.rpush(gen_key, *items[i:i+CHUNK_SIZE])
+        pipe.expire(gen_key, seconds)
+        pipe.execute()
+    swap(gen_key, key, seconds, on_swap)
@@ -17,14 +17,27 @@
 import time
 import json
 
+from topsupergroupsbot import config
 from topsupergroupsbot import database as db
+from topsupergroupsbot import rollups
+from topsupergroupsbot import singleflight
+from topsupergroupsbot import cache_publish
+from topsupergroupsbot.tiered_cache import TieredCache
 from collections import OrderedDict
 
 from telegram.ext.dispatcher import run_async
 
 CACHE_SECONDS = 60*3
+# older stats are served while they are refreshed in background, until
+# they expire
+SOFT_CACHE_SECONDS = CACHE_SECONDS*1.5
+HARD_CACHE_SECONDS = CACHE_SECONDS*5
 LATEST_UPDATE_KEY = 'latest_update'
+WEEK_KEY = 'week'
 REDIS_KEY = 'cached_users'
+DIRTY_KEY = 'cached_users_dirty'
+
+_users_cache = TieredCache('Users stats', config.TIERED_CACHE_SIZE)
 
 def group_extract(lst):
     # thank https://stackoverflow.com/a/46493187/8372336 for the help in this func
@@ -41,70 +54,306 @@ def group_extract(lst):
 
 @run_async
 def cache_users_stats(bot, job):
+    fill_cache()
+
+
+@run_async
+def rebuild_users_stats(bot, job):
+    fill_cache(full=True)
+
+
+# users who sent or retracted messages since the last refresh. Only them,
+# and the users their messages moved in the ranks, are computed again.
+# The ranks written in the cache are kept in users_stats_ranks and
+# users_stats_positions to find the ones that moved. The global ranks are
+# kept with the totals they are ordered by, so only the users between the
+# old and the new totals of the dirty ones are ranked again
+
+def mark_dirty(user_ids):
+    user_ids = set(user_ids)
+    if len(user_ids) > 0:  # to avoid to run sadd with one param
+        db.REDIS.sadd(DIRTY_KEY, *user_ids)
+
+
+def pop_dirty():
+    pipe = db.REDIS.pipeline()
+    pipe.smembers(DIRTY_KEY)
+    pipe.delete(DIRTY_KEY)
+    return [int(i.decode('UTF-8')) for i in pipe.execute()[0]]
+
+
+def fill_cache(full=False):
+    """
+    refresh the cached users. It's a full rebuild if asked, if the
+    week changed or if the cache is missing, otherwise only the dirty
+    users and the ones who moved are written
+    """
     at_seconds = time.time()
-    lst = get_all_users_stats()
+    week = str(rollups.current_week())
+    cached_week, latest_update = db.REDIS.hmget(REDIS_KEY, WEEK_KEY, LATEST_UPDATE_KEY)
+    full = (
+        full
+        or latest_update is None
+        or cached_week is None
+        or cached_week.decode('UTF-8') != week
+        or not ranks_stored())
+    dirty = pop_dirty()
+    try:
+        if full:
+            lst, computed = rebuild_ranks(), []
+        else:
+            lst, computed = refresh_ranks(dirty)
+    except Exception:
+        mark_dirty(dirty)  # the next refresh will retry them
+        raise
+
     dct = {}
     for i in lst:
         user_id = i[0][0]
         dct[user_id] = json.dumps(i).encode('UTF-8')
     dct[LATEST_UPDATE_KEY] = at_seconds
-    db.REDIS.hmset(REDIS_KEY, dct)
-    db.REDIS.expire(REDIS_KEY, CACHE_SECONDS*2)
+    dct[WEEK_KEY] = week
+    if full:
+        # users of the previous week must not stay in the hash
+        cache_publish.publish_hash(REDIS_KEY, dct, HARD_CACHE_SECONDS)
+        return
+    written = {i[0][0] for i in lst}
+    # computed users without messages left (retracted)
+    removed = [i for i in computed if i not in written]
+    pipe = db.REDIS.pipeline()
+    pipe.hmset(REDIS_KEY, dct)
+    if len(removed) > 0:
+        pipe.hdel(REDIS_KEY, *removed)
+    pipe.expire(REDIS_KEY, HARD_CACHE_SECONDS)
+    pipe.execute()
+
+
+def read_cached_user(user_id):
+    def load():
+        user_cache = db.REDIS.hget(REDIS_KEY, user_id)
+        return user_cache if user_cache is None else json.loads(user_cache.decode('UTF-8'))
+
+    # every refresh writes latest_update, it's the generation of the users
+    latest_update = db.REDIS.hget(REDIS_KEY, LATEST_UPDATE_KEY)
+    if latest_update is None:
+        return None, None
+    user_cache = _users_cache.get(int(user_id), latest_update, load)
+    return user_cache, float(latest_update.decode('UTF-8'))
 
 
 def get_cached_user(user_id):
-    user_cache, latest_update = db.REDIS.hmget(REDIS_KEY, user_id, LATEST_UPDATE_KEY)
-    user_cache = user_cache if user_cache is None else json.loads(user_cache.decode('UTF-8'))
-    latest_update = latest_update if latest_update is None else float(latest_update.decode('UTF-8'))
+    """
+    if the whole cache expired (the job is late) it's filled now,
+    only once for all the users asking meanwhile. If it's just old
+    it's returned and refreshed in background
+    """
+    def load():
+        user_cache, latest_update = read_cached_user(user_id)
+        return None if latest_update is None else (user_cache, latest_update)
+
+    def compute():
+        fill_cache()
+        return read_cached_user(user_id)
+
+    user_cache, latest_update = read_cached_user(user_id)
+    if latest_update is None:
+        return singleflight.fill(REDIS_KEY, load, compute)
+    if time.time() - latest_update > SOFT_CACHE_SECONDS:
+        singleflight.refresh(REDIS_KEY, fill_cache)
     return user_cache, latest_update
 
-def get_all_users_stats():
-    query = """
-        WITH tleft AS (
-        SELECT  main.user_id, u.lang, main.num_msgs, main.num_grps, main.rnk 
-        FROM (
+# this week's messages of the users, {} filters the users
+TOTALS_QUERY = """
+    SELECT
+        user_id,
+        SUM(amount)     AS num_msgs,
+        COUNT(group_id) AS num_grps
+    FROM user_week_counts
+    WHERE week = date_trunc('week', now())::date
+        AND amount > 0
+        {}
+    GROUP BY user_id
+"""
+
+# every user with the global rank. The order is total (user_id breaks the
+# ties), so the rank is the position in users_stats_ranks
+RANKS_QUERY = """
+    SELECT
+        user_id,
+        RANK() OVER(ORDER BY num_msgs DESC, num_grps DESC, user_id DESC) rnk,
+        num_msgs,
+        num_grps
+    FROM ({}) AS sub
+""".format(TOTALS_QUERY.format(""))
+
+# position of the users inside the groups, {} filters the groups
+POSITIONS_QUERY = """
+    SELECT
+        group_id,
+        user_id,
+        RANK() OVER (PARTITION BY group_id ORDER BY amount DESC) AS pos
+    FROM user_week_counts
+    WHERE week = date_trunc('week', now())::date
+        AND amount > 0
+        {}
+"""
+
+# the stats of the users, from the ranks written above. {} filters the users
+STATS_QUERY = """
+    WITH totals AS (
         SELECT
             user_id,
-            num_grps,
-            num_msgs,
-            RANK() OVER(ORDER BY num_msgs DESC, num_grps DESC, user_id DESC) rnk
-        FROM (
+            COUNT(group_id) AS num_grps,
+            SUM(amount)     AS num_msgs
+        FROM user_week_counts
+        WHERE week = date_trunc('week', now())::date
+            AND amount > 0
+            {}
+        GROUP BY user_id
+    )
+    SELECT t.user_id, u.lang, t.num_msgs, t.num_grps, r.rnk, s_ref.title, s_ref.username, c.amount, p.pos
+    FROM totals AS t
+    INNER JOIN users AS u
+    USING (user_id)
+    INNER JOIN users_stats_ranks AS r
+    USING (user_id)
+    INNER JOIN user_week_counts AS c
+    ON c.user_id = t.user_id
+        AND c.week = date_trunc('week', now())::date
+        AND c.amount > 0
+    INNER JOIN users_stats_positions AS p
+    ON p.group_id = c.group_id AND p.user_id = c.user_id
+    LEFT OUTER JOIN supergroups_ref AS s_ref
+    ON s_ref.group_id = c.group_id
+    WHERE u.weekly_own_digest = TRUE
+        AND bot_blocked = FALSE
+    ORDER BY t.user_id, c.amount DESC
+"""
+
+
+# the monday job and a refresh of the cache of another instance could
+# write the ranks at the same time
+LOCK_QUERY = "LOCK TABLE users_stats_ranks, users_stats_positions IN EXCLUSIVE MODE"
+
+
+def ranks_stored():
+    """false if there are no ranks to refresh, e.g. the unlogged table
+    has been emptied by a crash of postgresql"""
+    return db.query_r("SELECT EXISTS (SELECT 1 FROM users_stats_ranks)", one=True)[0]
+
+
+def rebuild_ranks():
+    """rank all the users again and return the stats of all of them"""
+    with db.transaction() as c:
+        c.execute(LOCK_QUERY)
+        c.execute("DELETE FROM users_stats_ranks")
+        c.execute("DELETE FROM users_stats_positions")
+        c.execute("INSERT INTO users_stats_ranks(user_id, rnk, num_msgs, num_grps) " + RANKS_QUERY)
+        c.execute(
+            "INSERT INTO users_stats_positions(group_id, user_id, pos) " +
+            POSITIONS_QUERY.format(""))
+        c.execute(STATS_QUERY.format(""))
+        return group_extract(c.fetchall())
+
+
+def refresh_ranks(dirty):
+    """
+    return the stats of the dirty users and of the ones whose global
+    rank or position in the groups of the dirty users changed, and the
+    ids of all of them
+    """
+    with db.transaction() as c:
+        c.execute(LOCK_QUERY)
+        ranks_changed = refresh_global_ranks(c, dirty)
+        # only changed positions are written and returned
+        c.execute("""
+            WITH positions AS ({}), 
+            positions_changed AS (
+                INSERT INTO users_stats_positions AS p (group_id, user_id, pos)
+                SELECT group_id, user_id, pos FROM positions
+                ON CONFLICT (group_id, user_id) DO
+                UPDATE SET pos = EXCLUDED.pos
+                WHERE p.pos <> EXCLUDED.pos
+                RETURNING user_id
+            )
+            SELECT user_id FROM positions_changed
+        """.format(
+            POSITIONS_QUERY.format("""
+                AND group_id IN (
+                    SELECT group_id
+                    FROM user_week_counts
+                    WHERE week = date_trunc('week', now())::date
+                        AND user_id = ANY(%(dirty)s)
+                )""")),
+            {'dirty': dirty})
+        computed = list(set(dirty) | ranks_changed | {i[0] for i in c.fetchall()})
+        if len(computed) == 0:
+            return [], computed
+        c.execute(STATS_QUERY.format("AND user_id = ANY(%(computed)s)"), {'computed': computed})
+        return group_extract(c.fetchall()), computed
+
+
+def refresh_global_ranks(c, dirty):
+    """
+    write the totals of the dirty users and rank again only the users
+    they moved. Returns the ids of the users whose rank changed
+    """
+    c.execute(TOTALS_QUERY.format("AND user_id = ANY(%(dirty)s)"), {'dirty': dirty})
+    new = c.fetchall()
+    c.execute(
+        "SELECT num_msgs, num_grps, user_id FROM users_stats_ranks WHERE user_id = ANY(%s)",
+        (dirty,))
+    old = [tuple(i) for i in c.fetchall()]
+    # a key is ordered like the ranks: the higher, the better the rank
+    keys = [(i[1], i[2], i[0]) for i in new] + old
+    if len(keys) == 0:
+        return set()
+    top, bottom = max(keys), min(keys)
+
+    # the users above top keep their rank, no dirty user was among them
+    c.execute("""
+        SELECT rnk - 1 FROM users_stats_ranks
+        WHERE (num_msgs, num_grps, user_id) <= %s
+        ORDER BY num_msgs DESC, num_grps DESC, user_id DESC
+        LIMIT 1""", (top,))
+    row = c.fetchone()
+    if row is None:
+        # nobody below top: the last rank is the amount of users
+        c.execute("SELECT rnk FROM users_stats_ranks ORDER BY num_msgs, num_grps, user_id LIMIT 1")
+        row = c.fetchone()
+    above = row[0] if row is not None else 0
+
+    c.execute("DELETE FROM users_stats_ranks WHERE user_id = ANY(%s)", (dirty,))
+    if len(new) > 0:
+        c.execute("""
+            INSERT INTO users_stats_ranks (user_id, num_msgs, num_grps)
+            SELECT * FROM unnest(%s::bigint[], %s::bigint[], %s::bigint[])
+            """, ([i[0] for i in new], [i[1] for i in new], [i[2] for i in new]))
+
+    # the users between the old and the new totals of the dirty ones
+    c.execute("""
+        WITH ranked AS (
             SELECT
                 user_id,
-                COUNT(distinct group_id) AS num_grps,
-                COUNT(*)                 AS num_msgs
-            FROM messages
-            WHERE message_date > date_trunc('week', now())
-            GROUP BY user_id
-            ) AS sub
-        ) AS main
-        LEFT OUTER JOIN users AS u
-        USING (user_id)
-        WHERE u.weekly_own_digest = TRUE
-        AND bot_blocked = FALSE
-        )
-        , tright AS (
-        SELECT main.user_id, main.group_id, s_ref.title, s_ref.username, main.m_per_group, main.pos
-        FROM (
-            SELECT user_id, group_id, COUNT(user_id) AS m_per_group,
-                RANK() OVER (
-                    PARTITION BY group_id
-                    ORDER BY COUNT(group_id) DESC
-                    ) AS pos 
-            FROM messages
-            WHERE message_date > date_trunc('week', now())
-            GROUP BY group_id, user_id
-        ) AS main 
-        LEFT OUTER JOIN supergroups_ref AS s_ref
-        USING (group_id)
-        ORDER BY m_per_group DESC
+                %(above)s + ROW_NUMBER() OVER(ORDER BY num_msgs DESC, num_grps DESC, user_id DESC) AS rnk
+            FROM users_stats_ranks
+            WHERE (num_msgs, num_grps, user_id) BETWEEN %(bottom)s AND %(top)s
         )
-        SELECT l.user_id, l.lang, l.num_msgs, l.num_grps, l.rnk, r.title, r.username, r.m_per_group, r.pos
-        FROM tleft AS l
-        INNER JOIN tright AS r
-        USING (user_id)
-        """
-    return group_extract(db.query_r(query))
-    # for i in extract: i[0] = (user_id, lang, msg, grps, pos)
-    # i[1] = [[],[]] anyone inside = [groupname, groupusername, msg in group, pos in group]
+        UPDATE users_stats_ranks AS r
+        SET rnk = ranked.rnk
+        FROM ranked
+        WHERE r.user_id = ranked.user_id AND r.rnk IS DISTINCT FROM ranked.rnk
+        RETURNING r.user_id
+        """, {'above': above, 'bottom': bottom, 'top': top})
+    changed = {i[0] for i in c.fetchall()}
 
+    # the users below bottom move only if users got in or out of the ranks
+    shift = len(new) - len(old)
+    if shift != 0:
+        c.execute("""
+            UPDATE users_stats_ranks SET rnk = rnk + %s
+            WHERE (num_msgs, num_grps, user_id) < %s
+            RETURNING user_id
+            """, (shift, bottom))
+        changed |= {i[0] for i in c.fetchall()}
+    return changed
@@ -15,20 +15,43 @@
 # along with TopSupergroupsBot.  If not, see <http://www.gnu.org/licenses/>.
 
 from topsupergroupsbot import database
+from topsupergroupsbot import group_settings
+from topsupergroupsbot import partitions
 
 from telegram.ext.dispatcher import run_async
 
 CLEAN_INTERVAL = '1 month'
+# hours summed by the leaderboards of the longest rolling window
+HOURS_INTERVAL = '31 days'
 
 
 @run_async
 def clean_db(bot, job):
-    query = "DELETE FROM messages WHERE message_date < now() - interval %s"
+    if partitions.is_partitioned('messages'):
+        partitions.drop_old_partitions('messages', CLEAN_INTERVAL)
+    else:
+        query = "DELETE FROM messages WHERE message_date < now() - interval %s"
+        database.query_w(query, CLEAN_INTERVAL)
+
+    if partitions.is_partitioned('members'):
+        partitions.drop_old_partitions('members', CLEAN_INTERVAL)
+    else:
+        query = "DELETE FROM members WHERE updated_date < now() - interval %s"
+        database.query_w(query, CLEAN_INTERVAL)
+
+    query = "DELETE FROM members_latest WHERE updated_date < now() - interval %s"
     database.query_w(query, CLEAN_INTERVAL)
 
-    query = "DELETE FROM members WHERE updated_date < now() - interval %s"
+    # weeks of the rollups whose messages have been deleted
+    query = "DELETE FROM group_week_counts WHERE week < date_trunc('week', now() - interval %s)"
     database.query_w(query, CLEAN_INTERVAL)
 
+    query = "DELETE FROM user_week_counts WHERE week < date_trunc('week', now() - interval %s)"
+    database.query_w(query, CLEAN_INTERVAL)
+
+    query = "DELETE FROM group_hour_counts WHERE hour < now() - interval %s"
+    database.query_w(query, HOURS_INTERVAL)
+
 
 @run_async
 def check_bot_inside_in_inactive_groups(bot, job):
@@ -84,6 +107,7 @@ def send_chat_action_inactive_group(bot, job):
 			print('right usage in clean_db inactive groups')
 			query = "UPDATE supergroups SET bot_inside=FALSE WHERE group_id=%s"
 			database.query_w(query, group_id)
+			group_settings.invalidate(group_id)
 		else:
 			print(e)
 			print("cleandb inactive groups")
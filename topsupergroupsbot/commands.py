@@ -30,18 +30,14 @@ from topsupergroupsbot import supported_langs
 from topsupergroupsbot import emojis
 from topsupergroupsbot import cache_users_stats
 from topsupergroupsbot import cache_groups_rank
+from topsupergroupsbot import group_settings
+from topsupergroupsbot import user_profile
+from topsupergroupsbot import live_leaderboard
 
 
 def first_start(bot, update):
     user_id = update.message.from_user.id
-    query = """
-        SELECT 1 
-        FROM USERS 
-        WHERE user_id = %s 
-        FETCH FIRST 1 ROW ONLY
-    """
-    extract = database.query_r(query, user_id, one=True)
-    if extract is None:  # this is the first time the user starts the bot
+    if user_profile.get(user_id) is None:  # this is the first time the user starts the bot
         # send region choose
         guessed_lang = utils.guessed_user_lang(bot, update)
         text = get_lang.get_string(guessed_lang, "choose_region")
@@ -247,8 +243,7 @@ def settings_private(bot, update):
 
 @utils.admin_command_only()
 def settings_group(bot, update):
-    query_db = "SELECT lang FROM supergroups WHERE group_id = %s"
-    lang = database.query_r(query_db, update.message.chat.id, one=True)[0]
+    lang = group_settings.get_lang(update.message.chat.id)
     text = get_lang.get_string(lang, "choose_group_lang")
     reply_markup = keyboards.main_group_settings_kb(lang)
     update.message.reply_text(text=text, reply_markup=reply_markup, quote=False)
@@ -271,10 +266,9 @@ def language(bot, update):
 
 @utils.private_only
 def region(bot, update):
-    query = "SELECT lang, region FROM users WHERE user_id = %s"
-    extract = database.query_r(query, update.message.from_user.id, one=True)
-    lang = extract[0]
-    region = extract[1]
+    profile = user_profile.get(update.message.from_user.id)
+    lang = profile.lang
+    region = profile.region
     text = get_lang.get_string(lang, "choose_region")
     reply_markup = keyboards.private_region_kb(lang, region)
     update.message.reply_text(text=text, reply_markup=reply_markup)
@@ -288,9 +282,7 @@ def language_group(bot, update):
 # this does not need the only private decorator cause the command has the same
 # name for groups
 def language_private(bot, update):
-    query = "SELECT lang FROM users WHERE user_id = %s"
-    extract = database.query_r(query, update.message.from_user.id, one=True)
-    lang = extract[0]
+    lang = utils.get_db_lang(update.message.from_user.id)
     text = get_lang.get_string(lang, "choose_your_lang")
     reply_markup = keyboards.private_language_kb(lang, back=False)
     update.message.reply_text(text=text, reply_markup=reply_markup)
@@ -393,10 +385,9 @@ def aboutyou(bot, update):
 
 @utils.private_only
 def leaderboard(bot, update):
-    query = "SELECT lang, region FROM users WHERE user_id = %s"
-    extract = database.query_r(query, update.message.from_user.id, one=True)
-    lang = extract[0]
-    region = extract[1]
+    profile = user_profile.get(update.message.from_user.id)
+    lang = profile.lang
+    region = profile.region
     text = get_lang.get_string(lang, "generic_leaderboard").format(supported_langs.COUNTRY_FLAG[region])
     reply_markup = keyboards.generic_leaderboard_kb(lang, region)
     update.message.reply_text(text=text, reply_markup=reply_markup, parse_mode="HTML")
@@ -436,8 +427,7 @@ def start_help_buttons(bot, update):
 
 @utils.admin_command_only(possible_in_private=True)
 def group_rank(bot, update):
-    query = "SELECT lang FROM supergroups WHERE group_id = %s"
-    lang = database.query_r(query, update.message.chat.id, one=True)[0]
+    lang = group_settings.get_lang(update.message.chat.id)
     update.message.reply_text(text=group_rank_text(update.message.chat.id, lang), parse_mode='HTML', quote=False)
 
 
@@ -447,6 +437,16 @@ def group_rank_text(group_id, lang):
     if rank is None:
         return strings['None']
 
+    # the live leaderboard is more recent for messages
+    if cache_groups_rank.BY_MESSAGES in rank:
+        # copied, the cached rank is shared with the other requests
+        rank = dict(rank)
+        by_messages = rank[cache_groups_rank.BY_MESSAGES] = dict(rank[cache_groups_rank.BY_MESSAGES])
+        live = live_leaderboard.rank(by_messages[cache_groups_rank.REGION], group_id)
+        if live is not None:
+            by_messages[cache_groups_rank.RANK], by_messages[cache_groups_rank.VALUE] = live
+            by_messages[cache_groups_rank.CACHED_AT] = live_leaderboard.updated_at() or time.time()
+
     text = strings['title']
     # by messages
     try:
@@ -21,6 +21,15 @@ from topsupergroupsbot import database
 from topsupergroupsbot import utils
 from topsupergroupsbot import get_lang
 from topsupergroupsbot import categories
+from topsupergroupsbot import ingest_buffer
+from topsupergroupsbot import antiflood
+from topsupergroupsbot import ref_cache
+from topsupergroupsbot import group_settings
+from topsupergroupsbot import user_profile
+from topsupergroupsbot import rollups
+from topsupergroupsbot import leaderboards
+from topsupergroupsbot import singleflight
+from topsupergroupsbot import tiered_cache
 
 from telegram.error import (TelegramError, 
                             Unauthorized, 
@@ -28,6 +37,7 @@ from telegram.error import (TelegramError,
                             TimedOut, 
                             ChatMigrated, 
                             NetworkError)
+from telegram.ext.dispatcher import run_async
 
 
 @utils.bot_owner_only
@@ -117,6 +127,34 @@ def stats_groups(bot, update):
     update.message.reply_text(text=text, parse_mode='HTML')
 
 
+def stats_section(title, dct):
+    text = "<b>{}:</b>\n".format(title)
+    for k, v in sorted(dct.items()):
+        text += "— <b>{}:</b> {}\n".format(k, round(v, 4) if isinstance(v, float) else v)
+    return text
+
+
+@utils.bot_owner_only
+def stats_perf(bot, update):
+    text = stats_section("Ingest buffer", ingest_buffer.stats())
+    text += "\n" + stats_section("Antiflood", antiflood.stats())
+    text += "\n" + stats_section("Refs upsert cache", ref_cache.stats())
+    text += "\n" + stats_section("Group settings cache", group_settings.stats())
+    text += "\n" + stats_section("User profile cache", user_profile.stats())
+    text += "\n" + stats_section("Leaderboard pages cache", leaderboards.rendered_pages_stats())
+    text += "\n" + stats_section("Single-flight fills", singleflight.stats())
+    for name, dct in sorted(tiered_cache.stats().items()):
+        text += "\n" + stats_section("{} cache (memory/redis)".format(name), dct)
+    update.message.reply_text(text=text, parse_mode='HTML')
+
+
+@run_async
+@utils.bot_owner_only
+def rebuild_rollups(bot, update):
+    text = stats_section("Rebuilt rollups", rollups.rebuild_all())
+    update.message.reply_text(text=text, parse_mode='HTML')
+
+
 @utils.bot_owner_only
 def infoid(bot, update, args):
     if len(args) != 1:
@@ -247,6 +285,7 @@ def ban_group(bot, update, args):
     """
 
     extract = database.query_wr(query, days, reason, group_id, one=True)
+    group_settings.invalidate(group_id)
     lang = extract[0]
     banned_until = extract[1]
     shown_reason = html.escape(reason) if reason is not None else get_lang.get_string(lang, "not_specified")
@@ -263,6 +302,7 @@ def ban_group(bot, update, args):
 
     query = "UPDATE supergroups SET bot_inside = FALSE WHERE group_id = %s"
     database.query_w(query, group_id)
+    group_settings.invalidate(group_id)
     update.message.reply_text("Done!")
 
 
@@ -281,4 +321,5 @@ def unban_group(bot, update, args):
         WHERE group_id = %s
     """
     database.query_w(query, group_id)
+    group_settings.invalidate(group_id)
     update.message.reply_text("unbanned", quote=True)
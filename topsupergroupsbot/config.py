@@ -54,6 +54,12 @@ FOUNDER = conf["founder"]
 
 FLOOD_CHECKS = conf["flood_checks"]
 
+# 'fixed' (counters reset at the end of each interval) or 'sliding'
+try:
+    FLOOD_MODE = conf["flood_mode"]
+except KeyError:
+    FLOOD_MODE = 'fixed'
+
 try:
     OFFICIAL_CHANNEL = conf["official_channel"]
 except KeyError:
@@ -62,4 +68,84 @@ except KeyError:
 try:
     DONATE_ADDRESSES = conf["donate_addresses"]
 except KeyError:
-    DONATE_ADDRESSES = None
\ No newline at end of file
+    DONATE_ADDRESSES = None
+
+# write-behind buffer for the messages table
+try:
+    INGEST_FLUSH_SIZE = conf["ingest_flush_size"]
+except KeyError:
+    INGEST_FLUSH_SIZE = 500
+
+try:
+    INGEST_FLUSH_INTERVAL = conf["ingest_flush_interval"]
+except KeyError:
+    INGEST_FLUSH_INTERVAL = 5
+
+# rows kept in memory at most while the database can't be written
+try:
+    INGEST_MAX_BUFFER = conf["ingest_max_buffer"]
+except KeyError:
+    INGEST_MAX_BUFFER = 100000
+
+# failed flushes of the same rows before looking for the bad ones
+try:
+    INGEST_MAX_RETRIES = conf["ingest_max_retries"]
+except KeyError:
+    INGEST_MAX_RETRIES = 3
+
+# users_ref and supergroups_ref are rewritten only if the profile changed
+# or at least every `ref_refresh_interval` seconds
+try:
+    REF_REFRESH_INTERVAL = conf["ref_refresh_interval"]
+except KeyError:
+    REF_REFRESH_INTERVAL = 60*60
+
+try:
+    REF_CACHE_SIZE = conf["ref_cache_size"]
+except KeyError:
+    REF_CACHE_SIZE = 100000
+
+# in-process cache of the settings of the groups
+try:
+    GROUP_SETTINGS_CACHE_TTL = conf["group_settings_cache_ttl"]
+except KeyError:
+    GROUP_SETTINGS_CACHE_TTL = 60*10
+
+try:
+    GROUP_SETTINGS_CACHE_SIZE = conf["group_settings_cache_size"]
+except KeyError:
+    GROUP_SETTINGS_CACHE_SIZE = 50000
+
+# in-process cache of the private settings of the users
+try:
+    USER_PROFILE_CACHE_TTL = conf["user_profile_cache_ttl"]
+except KeyError:
+    USER_PROFILE_CACHE_TTL = 60*30
+
+try:
+    USER_PROFILE_CACHE_SIZE = conf["user_profile_cache_size"]
+except KeyError:
+    USER_PROFILE_CACHE_SIZE = 100000
+
+# rendered pages of the private leaderboards kept in memory
+try:
+    LEADERBOARD_PAGES_CACHE_SIZE = conf["leaderboard_pages_cache_size"]
+except KeyError:
+    LEADERBOARD_PAGES_CACHE_SIZE = 5000
+
+# decoded values of the redis caches kept in memory, for each cache
+try:
+    TIERED_CACHE_SIZE = conf["tiered_cache_size"]
+except KeyError:
+    TIERED_CACHE_SIZE = 20000
+
+# messages and members partitioned by week (postgresql >= 11)
+try:
+    PARTITIONING = conf["partitioning"]
+except KeyError:
+    PARTITIONING = False
+
+try:
+    PARTITIONS_AHEAD = conf["partitions_ahead"]
+except KeyError:
+    PARTITIONS_AHEAD = 4
@@ -15,7 +15,9 @@
 # along with TopSupergroupsBot.  If not, see <http://www.gnu.org/licenses/>.
 
 import threading
+import uuid
 import redis
+from contextlib import contextmanager
 import psycopg2
 from psycopg2 import pool
 from threading import Semaphore
@@ -96,6 +98,67 @@ def query_r(raw_query, *params, one=False):
 query_wr = query_r
 
 
+@contextmanager
+def transaction():
+    """
+    yield a cursor to run more statements in the same transaction.
+    it commits at the end of the block or rolls back if something is raised
+    """
+    connect = DB_POOL_CONNECTIONS.getconn()
+    c = connect.cursor()
+    try:
+        yield c
+        c.connection.commit()
+    except:
+        c.connection.rollback()
+        raise
+    finally:
+        DB_POOL_CONNECTIONS.putconn(connect)
+
+
+def query_stream(raw_query, *params, itersize=1000):
+    """
+    yield the rows of a read query through a server-side (named) cursor,
+    fetching `itersize` rows per round trip instead of loading all of
+    them in memory. The connection is held until the rows are consumed
+    """
+    connect = DB_POOL_CONNECTIONS.getconn()
+    c = connect.cursor(name='stream_{}'.format(uuid.uuid4().hex))
+    c.itersize = itersize
+    try:
+        c.execute(raw_query, params)
+        for row in c:
+            yield row
+        c.close()
+        connect.commit()
+    except:
+        connect.rollback()
+        raise
+    finally:
+        DB_POOL_CONNECTIONS.putconn(connect)
+
+
+def create_materialized_view(name, query, version, unique_columns, index_columns=None):
+    """
+    create the materialized view, or create it again if it has been created
+    by another version of the query. The version is kept as comment of the
+    view. The unique index is needed to refresh it concurrently
+    """
+    extract = query_r(
+        "SELECT obj_description(oid, 'pg_class') FROM pg_class WHERE relname = %s AND relkind = 'm'",
+        name,
+        one=True)
+    if extract is not None and extract[0] == version:
+        return
+    with transaction() as c:
+        c.execute("DROP MATERIALIZED VIEW IF EXISTS {}".format(name))
+        c.execute("CREATE MATERIALIZED VIEW {} AS {}".format(name, query))
+        c.execute("CREATE UNIQUE INDEX {0}_unique ON {0} ({1})".format(name, unique_columns))
+        if index_columns is not None:
+            c.execute("CREATE INDEX {0}_index ON {0} ({1})".format(name, index_columns))
+        c.execute("COMMENT ON MATERIALIZED VIEW {} IS %s".format(name), (version, ))
+
+
 #                    _            _ _    
 #    __ _ _ ___ __ _| |_ ___   __| | |__ 
 #   / _| '_/ -_) _` |  _/ -_) / _` | '_ \
@@ -140,13 +203,24 @@ def create_db():
 
     # to collect messages for stats
 
-    query = """CREATE TABLE IF NOT EXISTS messages(
-        msg_id BIGINT, 
-        group_id BIGINT, 
-        user_id BIGINT, 
-        message_date timestamp, 
-        PRIMARY KEY (msg_id, group_id)
-    )"""
+    # partitioned tables need the partition key in the primary key.
+    # existing unpartitioned tables are migrated by partitions.setup
+    if config.PARTITIONING:
+        query = """CREATE TABLE IF NOT EXISTS messages(
+            msg_id BIGINT, 
+            group_id BIGINT, 
+            user_id BIGINT, 
+            message_date timestamp, 
+            PRIMARY KEY (msg_id, group_id, message_date)
+        ) PARTITION BY RANGE (message_date)"""
+    else:
+        query = """CREATE TABLE IF NOT EXISTS messages(
+            msg_id BIGINT, 
+            group_id BIGINT, 
+            user_id BIGINT, 
+            message_date timestamp, 
+            PRIMARY KEY (msg_id, group_id)
+        )"""
     query_w(query)
 
     # --------------------------
@@ -184,6 +258,25 @@ def create_db():
     )"""
     query_w(query)
 
+    # running sum and count of the votes of every group, kept updated
+    # when a vote is given or changed
+
+    query = """CREATE TABLE IF NOT EXISTS group_vote_stats(
+        group_id BIGINT PRIMARY KEY, 
+        votes_sum INT DEFAULT 0, 
+        votes_count INT DEFAULT 0
+    )"""
+    query_w(query)
+
+    query = """
+    INSERT INTO group_vote_stats(group_id, votes_sum, votes_count)
+    SELECT group_id, SUM(vote), COUNT(vote)
+    FROM votes
+    WHERE NOT EXISTS (SELECT 1 FROM group_vote_stats)
+    GROUP BY group_id
+    """
+    query_w(query)
+
     # --------------------------
 
     # for members
@@ -193,7 +286,108 @@ def create_db():
         group_id BIGINT, 
         amount INT, 
         updated_date timestamp
-    )
+    ) {}
+    """.format("PARTITION BY RANGE (updated_date)" if config.PARTITIONING else "")
+    query_w(query)
+
+    # the last row of members of every group, written with it
+    query = """CREATE TABLE IF NOT EXISTS members_latest(
+        group_id BIGINT PRIMARY KEY, 
+        amount INT, 
+        updated_date timestamp
+    )"""
+    query_w(query)
+
+    query = """
+    INSERT INTO members_latest(group_id, amount, updated_date)
+    SELECT DISTINCT ON (group_id) group_id, amount, updated_date
+    FROM members
+    WHERE NOT EXISTS (SELECT 1 FROM members_latest)
+    ORDER BY group_id, updated_date DESC
+    """
+    query_w(query)
+
+    # --------------------------
+
+    # rollups of messages, kept updated when messages are logged or retracted
+
+    query = """CREATE TABLE IF NOT EXISTS group_week_counts(
+        week DATE, 
+        group_id BIGINT, 
+        amount INT DEFAULT 0, 
+        PRIMARY KEY (week, group_id)
+    )"""
+    query_w(query)
+
+    # backfill from messages the first time
+    query = """
+    INSERT INTO group_week_counts(week, group_id, amount)
+    SELECT date_trunc('week', message_date)::date, group_id, COUNT(msg_id)
+    FROM messages
+    WHERE NOT EXISTS (SELECT 1 FROM group_week_counts)
+    GROUP BY 1, 2
+    """
+    query_w(query)
+
+    query = """CREATE TABLE IF NOT EXISTS user_week_counts(
+        week DATE, 
+        group_id BIGINT, 
+        user_id BIGINT, 
+        amount INT DEFAULT 0, 
+        PRIMARY KEY (week, group_id, user_id)
+    )"""
+    query_w(query)
+
+    query = """
+    INSERT INTO user_week_counts(week, group_id, user_id, amount)
+    SELECT date_trunc('week', message_date)::date, group_id, user_id, COUNT(msg_id)
+    FROM messages
+    WHERE NOT EXISTS (SELECT 1 FROM user_week_counts)
+    GROUP BY 1, 2, 3
+    """
+    query_w(query)
+
+    # ranks written in the cached users stats, to find the users who
+    # moved since the last refresh. Rebuilt by the full refresh
+    query = """CREATE UNLOGGED TABLE IF NOT EXISTS users_stats_ranks(
+        user_id BIGINT PRIMARY KEY, 
+        rnk BIGINT,
+        num_msgs BIGINT,
+        num_grps BIGINT
+    )"""
+    query_w(query)
+
+    # ranks written by older versions have no totals: they are removed and
+    # the next refresh of the users stats is a full one
+    query = """ALTER TABLE users_stats_ranks
+        ADD COLUMN IF NOT EXISTS num_msgs BIGINT,
+        ADD COLUMN IF NOT EXISTS num_grps BIGINT"""
+    query_w(query)
+    query_w("DELETE FROM users_stats_ranks WHERE num_msgs IS NULL")
+
+    query = """CREATE UNLOGGED TABLE IF NOT EXISTS users_stats_positions(
+        group_id BIGINT, 
+        user_id BIGINT, 
+        pos BIGINT, 
+        PRIMARY KEY (group_id, user_id)
+    )"""
+    query_w(query)
+
+    # for the leaderboards of rolling windows (last 24 hours, last 30 days)
+    query = """CREATE TABLE IF NOT EXISTS group_hour_counts(
+        hour timestamp, 
+        group_id BIGINT, 
+        amount INT DEFAULT 0, 
+        PRIMARY KEY (hour, group_id)
+    )"""
+    query_w(query)
+
+    query = """
+    INSERT INTO group_hour_counts(hour, group_id, amount)
+    SELECT date_trunc('hour', message_date), group_id, COUNT(msg_id)
+    FROM messages
+    WHERE NOT EXISTS (SELECT 1 FROM group_hour_counts)
+    GROUP BY 1, 2
     """
     query_w(query)
 
@@ -231,6 +425,20 @@ def create_index():
     query = "CREATE INDEX IF NOT EXISTS index_supergroups_ref_username ON supergroups_ref (username)"
     query_w(query)
 
+    #######################
+    #
+    #   USERS STATS
+    #
+    #######################
+
+    # the totals of the users who sent messages since the last refresh
+    query = "CREATE INDEX IF NOT EXISTS index_user_week_counts_user_id ON user_week_counts (week, user_id)"
+    query_w(query)
+    # the users between the old and the new rank of the ones who moved
+    query = """CREATE INDEX IF NOT EXISTS index_users_stats_ranks_totals
+        ON users_stats_ranks (num_msgs, num_grps, user_id)"""
+    query_w(query)
+
 
 
 
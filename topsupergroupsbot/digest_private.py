@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with TopSupergroupsBot.  If not, see <http://www.gnu.org/licenses/>.
 
+import datetime
+
 from topsupergroupsbot import database
 from topsupergroupsbot import get_lang
 from topsupergroupsbot import keyboards
@@ -39,10 +41,21 @@ def group_extract(lst):
     return final
 
 
+def previous_week(today=None):
+    """monday of the week before the one of today"""
+    today = datetime.date.today() if today is None else today
+    return today - datetime.timedelta(days=today.weekday(), weeks=1)
+
+
 @run_async
 def weekly_own_private(bot, job):
-    interval = '7 days'
+    # scheduled on monday: the week before the run, the bot's calendar week,
+    # not depending on the exact time of the run or on the database time zone
+    send_weekly_own_private(bot, job, previous_week())
+
 
+def send_weekly_own_private(bot, job, week):
+    """week: date of the monday of the week of the digest"""
     query = """
     WITH tleft AS (
         SELECT  
@@ -61,10 +74,11 @@ def weekly_own_private(bot, job):
             FROM (
                 SELECT
                     user_id,
-                    COUNT(distinct group_id) AS num_grps,
-                    COUNT(*)                 AS num_msgs
-                FROM messages
-                WHERE message_date > now() - interval %s
+                    COUNT(group_id) AS num_grps,
+                    SUM(amount)     AS num_msgs
+                FROM user_week_counts
+                WHERE week = %s
+                    AND amount > 0
                 GROUP BY user_id
             ) AS sub
         ) AS main
@@ -87,14 +101,14 @@ def weekly_own_private(bot, job):
             SELECT 
                 user_id, 
                 group_id, 
-                COUNT(user_id) AS m_per_group,
+                amount AS m_per_group,
                 RANK() OVER (
                     PARTITION BY group_id
-                    ORDER BY COUNT(group_id) DESC
+                    ORDER BY amount DESC
                 ) AS pos 
-            FROM messages
-            WHERE message_date > now() - interval %s
-            GROUP BY group_id, user_id
+            FROM user_week_counts
+            WHERE week = %s
+                AND amount > 0
         ) AS main 
         LEFT OUTER JOIN supergroups_ref AS s_ref
         USING (group_id)
@@ -117,7 +131,7 @@ def weekly_own_private(bot, job):
     """
 
     # it returns the global stuff for all the users that want the private digist own
-    extract = database.query_r(query, interval, interval)
+    extract = database.query_r(query, week, week)
     data = (group_extract(extract))
     schedule_own_private_digest(bot, job, data)
     # for i in extract: i[0] = (user_id, lang, msg, grps, pos)
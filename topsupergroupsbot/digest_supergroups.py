@@ -16,12 +16,16 @@
 
 import html
 
+import datetime
+
 from topsupergroupsbot import database
+from topsupergroupsbot import digest_private
 from topsupergroupsbot import get_lang
 from topsupergroupsbot import keyboards
 from topsupergroupsbot import utils
 from topsupergroupsbot import emojis
 from topsupergroupsbot import leaderboards
+from topsupergroupsbot import group_settings
 from topsupergroupsbot import constants as c
 
 from telegram.error import (TelegramError, 
@@ -33,362 +37,227 @@ from telegram.error import (TelegramError,
 from telegram.ext.dispatcher import run_async
 
 
-@run_async
-def weekly_groups_digest(bot, job):
-    near_interval = '7 days'
-    far_interval = '14 days'
-
-    query = """
+# every metric of the digest, the week of the digest (new) and the one
+# before (old), given as the dates of their mondays,
+# computed for all the groups in one pass and joined by group_id, so each
+# group of the digest is one row. Ranks are among all the listed groups of
+# the same lang, 0 if the group is not ranked
+DIGEST_QUERY = """
+    WITH const AS (
+        SELECT %s::date AS new_week, %s::date AS old_week, %s::int AS min_reviews
+    ), listed AS (
+        SELECT group_id, lang
+        FROM supergroups
+        WHERE (banned_until IS NULL OR banned_until < now())
+            AND bot_inside IS TRUE
+    ),
+
+    ----------
+    -- MESSAGES
+    ----------
+    -- the digest runs at the beginning of the week, the rollup of the
+    -- previous week is complete
+    msgs AS (
+        SELECT
+            g.group_id,
+            g.week = const.new_week AS new,
+            g.amount,
+            RANK() OVER(PARTITION BY g.week, l.lang ORDER BY g.amount DESC) AS rank
+        FROM group_week_counts AS g
+        CROSS JOIN const
+        INNER JOIN listed AS l
+        ON l.group_id = g.group_id
+        WHERE g.week IN (const.new_week, const.old_week)
+            AND g.amount > 0
+    ),
+
+    ----------
+    -- MEMBERS
+    ----------
+    members_new AS (
+        SELECT
+            m.group_id,
+            m.amount,
+            RANK() OVER(PARTITION BY l.lang ORDER BY m.amount DESC) AS rank
+        FROM members_latest AS m
+        INNER JOIN listed AS l
+        ON l.group_id = m.group_id
+    ), members_old AS (
+        SELECT
+            m.group_id,
+            m.amount,
+            RANK() OVER(PARTITION BY l.lang ORDER BY m.amount DESC) AS rank
+        FROM (
+            SELECT DISTINCT ON (group_id) group_id, amount
+            FROM members
+            CROSS JOIN const
+            WHERE updated_date < const.new_week
+            ORDER BY group_id, updated_date DESC
+        ) AS m
+        INNER JOIN listed AS l
+        ON l.group_id = m.group_id
+    ),
+
+    ----------
+    -- VOTES
+    ----------
+    -- this week's are the rows of the votes leaderboard
+    votes_new AS (
+        SELECT group_id, amount, average, rank
+        FROM {votes_view}
+    ), votes_old_by_group AS (
+        SELECT
+            v.group_id,
+            l.lang,
+            COUNT(vote) AS amount,
+            ROUND(AVG(vote), 1)::float AS average,
+            AVG(vote)::float AS mean
+        FROM votes AS v
+        CROSS JOIN const
+        INNER JOIN listed AS l
+        ON l.group_id = v.group_id
+        WHERE v.vote_date < const.new_week
+        GROUP BY v.group_id, l.lang
+    ), votes_old_myconst AS (
         SELECT
-            group_id,
             lang,
-            nsfw,
-            joined_the_bot
-        FROM supergroups
-        WHERE weekly_digest = TRUE AND bot_inside = TRUE
-        ORDER BY last_date DESC
-        """
-    lst = database.query_r(query)
-
-    #############
-    # MESSAGES
-    ############
-
-    query = """
-        SELECT 
-            group_id,
-            COUNT(msg_id) AS msgs, 
-            RANK() OVER(PARTITION BY s.lang ORDER BY COUNT(msg_id) DESC)
-        FROM messages 
-        LEFT OUTER JOIN supergroups as s 
-        USING (group_id)
-        WHERE 
-            message_date > now() - interval %s
-            AND (s.banned_until IS NULL OR s.banned_until < now()) 
-            AND s.bot_inside IS TRUE
-        GROUP BY s.lang, group_id
+            SUM(mean * amount) / SUM(amount) AS overall_avg
+        FROM votes_old_by_group
+        GROUP BY lang
+        HAVING SUM(amount) >= (SELECT min_reviews FROM const)
+    ), votes_old AS (
+        SELECT
+            v.group_id,
+            v.amount,
+            v.average,
+            -- (WR) = (v ÷ (v+m)) × R + (m ÷ (v+m)) × C, see VotesLeaderboard
+            RANK() OVER (PARTITION BY v.lang ORDER BY (
+                (v.amount::float / (v.amount + const.min_reviews)) * v.mean
+                + (const.min_reviews::float / (v.amount + const.min_reviews)) * m.overall_avg
+            ) DESC) AS rank
+        FROM votes_old_by_group AS v
+        CROSS JOIN const
+        LEFT OUTER JOIN votes_old_myconst AS m
+        ON m.lang = v.lang
+        WHERE v.amount >= const.min_reviews
+    ),
+
+    ----------
+    -- ACTIVE USERS
+    ----------
+    -- users with messages in the group, the same weeks of the messages
+    active_users AS (
+        SELECT
+            u.group_id,
+            u.week = const.new_week AS new,
+            COUNT(u.user_id) AS amount,
+            RANK() OVER(PARTITION BY u.week, l.lang ORDER BY COUNT(u.user_id) DESC) AS rank
+        FROM user_week_counts AS u
+        CROSS JOIN const
+        INNER JOIN listed AS l
+        ON l.group_id = u.group_id
+        WHERE u.week IN (const.new_week, const.old_week)
+            AND u.amount > 0
+        GROUP BY u.group_id, u.week, l.lang, const.new_week
+    )
 
+    SELECT
+        s.group_id,
+        s.lang,
+        COALESCE(msgs_new.amount, 0), COALESCE(msgs_new.rank, 0),
+        COALESCE(msgs_old.amount, 0), COALESCE(msgs_old.rank, 0),
+        COALESCE(members_new.amount, 0), COALESCE(members_new.rank, 0),
+        COALESCE(members_old.amount, 0), COALESCE(members_old.rank, 0),
+        COALESCE(votes_new.amount, 0), COALESCE(votes_new.average, 0), COALESCE(votes_new.rank, 0),
+        COALESCE(votes_old.amount, 0), COALESCE(votes_old.average, 0), COALESCE(votes_old.rank, 0),
+        COALESCE(act_new.amount, 0), COALESCE(act_new.rank, 0),
+        COALESCE(act_old.amount, 0), COALESCE(act_old.rank, 0)
+    FROM supergroups AS s
+    LEFT OUTER JOIN msgs AS msgs_new
+    ON msgs_new.group_id = s.group_id AND msgs_new.new
+    LEFT OUTER JOIN msgs AS msgs_old
+    ON msgs_old.group_id = s.group_id AND NOT msgs_old.new
+    LEFT OUTER JOIN members_new
+    ON members_new.group_id = s.group_id
+    LEFT OUTER JOIN members_old
+    ON members_old.group_id = s.group_id
+    LEFT OUTER JOIN votes_new
+    ON votes_new.group_id = s.group_id
+    LEFT OUTER JOIN votes_old
+    ON votes_old.group_id = s.group_id
+    LEFT OUTER JOIN active_users AS act_new
+    ON act_new.group_id = s.group_id AND act_new.new
+    LEFT OUTER JOIN active_users AS act_old
+    ON act_old.group_id = s.group_id AND NOT act_old.new
+    WHERE s.weekly_digest = TRUE AND s.bot_inside = TRUE
+    ORDER BY s.last_date DESC
+"""
+
+
+# users listed in the digest of every group
+TOP_USERS = 10
+
+
+def get_top_users(week, limit):
     """
-    msgs_this_week = database.query_r(query, near_interval)
-
-    query = """
-        SELECT 
-            group_id, 
-            COUNT(msg_id) AS msgs,
-            RANK() OVER(PARTITION BY s.lang ORDER BY COUNT(msg_id) DESC)
-        FROM messages
-        LEFT OUTER JOIN supergroups as s 
-        USING (group_id)
-        WHERE 
-            message_date BETWEEN now() - interval %s AND now() - interval %s
-            AND (s.banned_until IS NULL OR s.banned_until < now()) 
-            AND s.bot_inside IS TRUE
-        GROUP BY s.lang, group_id
+    returns {group_id: [(user_id, messages, name, rank), ...]} with the
+    top users of the week (date of its monday) of all the groups of the
+    digest, from the users rollup in one query
     """
-    msgs_last_week = database.query_r(query, far_interval, near_interval)
-    
-    #############
-    # MEMBERS
-    ############
-
     query = """
-         SELECT
-            last_members.group_id,
-            last_members.amount, 
-            RANK() OVER(PARTITION BY s.lang ORDER BY last_members.amount DESC)
-        FROM
-            (
+        SELECT group_id, user_id, amount, name, rank
+        FROM (
             SELECT
-                *,
-                ROW_NUMBER() OVER (
-                    PARTITION BY group_id
-                    ORDER BY updated_date DESC
-                    ) AS row
-            FROM members
-        ) AS last_members 
-        LEFT OUTER JOIN supergroups AS s 
-        USING (group_id)
-        WHERE 
-            last_members.row=1
-            AND (s.banned_until IS NULL OR s.banned_until < now())
-            AND s.bot_inside IS TRUE
-    """
-    members_this_week = database.query_r(query)
-
-
-    query = """
-        SELECT 
-            last_members.group_id, 
-            last_members.amount,
-            RANK() OVER(PARTITION BY s.lang ORDER BY last_members.amount DESC)
-        FROM
-            (
-            SELECT 
-                *, 
-                ROW_NUMBER() OVER (
-                    PARTITION BY group_id
-                    ORDER BY updated_date DESC
-                    ) AS row 
-            FROM members
-            WHERE updated_date <= now() - interval %s
-        ) AS last_members 
-        LEFT OUTER JOIN supergroups AS s 
-        USING (group_id)
-        WHERE 
-            last_members.row=1
-            AND (s.banned_until IS NULL OR s.banned_until < now())
-            AND s.bot_inside IS TRUE
+                c.group_id,
+                c.user_id,
+                c.amount,
+                u_ref.name,
+                RANK() OVER (PARTITION BY c.group_id ORDER BY c.amount DESC) AS rank,
+                ROW_NUMBER() OVER (PARTITION BY c.group_id ORDER BY c.amount DESC) AS row
+            FROM user_week_counts AS c
+            INNER JOIN supergroups AS s
+            ON s.group_id = c.group_id
+            LEFT OUTER JOIN users_ref AS u_ref
+            ON u_ref.user_id = c.user_id
+            WHERE c.week = %s
+                AND c.amount > 0
+                AND s.weekly_digest = TRUE 
+                AND s.bot_inside = TRUE
+        ) AS top
+        WHERE row <= %s
+        ORDER BY group_id, row
         """
-    members_last_week = database.query_r(query, near_interval)
+    top_users = {}
+    for row in database.query_r(query, week, limit):
+        top_users.setdefault(row[0], []).append(row[1:])
+    return top_users
 
-    ####################
-    # SUM AND AVG VOTES
-    ####################
 
-    query = """
-        WITH myconst AS
-        (SELECT 
-            s.lang,
-            AVG(vote)::float AS overall_avg
-        FROM votes AS v
-        LEFT OUTER JOIN supergroups AS s
-        ON s.group_id = v.group_id
-        WHERE (s.banned_until IS NULL OR s.banned_until < now() )
-        AND s.bot_inside IS TRUE
-        GROUP BY s.lang
-        HAVING COUNT(vote) >= %s)
-
-        SELECT 
-          *,
-          RANK() OVER (PARTITION BY sub.lang  ORDER BY bayesan DESC)
-          FROM (
-            SELECT 
-                v.group_id,
-                s_ref.title, 
-                s_ref.username, 
-                COUNT(vote) AS amount, 
-                ROUND(AVG(vote), 1)::float AS average,
-                s.nsfw,
-                extract(epoch from s.joined_the_bot at time zone 'utc') AS dt,
-                s.lang,
-                s.category,
-                -- (WR) = (v ÷ (v+m)) × R + (m ÷ (v+m)) × C
-                --    * R = average for the movie (mean) = (Rating)
-                --    * v = number of votes for the movie = (votes)
-                --    * m = minimum votes required to be listed in the Top 250 (currently 1300)
-                --    * C = the mean vote across the whole report (currently 6.8)
-                (  (COUNT(vote)::float / (COUNT(vote)+%s)) * AVG(vote)::float + (%s::float / (COUNT(vote)+%s)) * (m.overall_avg) ) AS bayesan
-            FROM votes AS v
-            LEFT OUTER JOIN supergroups_ref AS s_ref
-            ON s_ref.group_id = v.group_id
-            LEFT OUTER JOIN supergroups AS s
-            ON s.group_id = v.group_id
-            LEFT OUTER JOIN myconst AS m
-            ON (s.lang = m.lang)
-            GROUP BY v.group_id, s_ref.title, s_ref.username, s.nsfw, s.banned_until, s.lang, s.category, s.bot_inside, s.joined_the_bot, m.overall_avg
-            HAVING 
-                (s.banned_until IS NULL OR s.banned_until < now()) 
-                AND COUNT(vote) >= %s
-                AND s.bot_inside IS TRUE
-          ) AS sub;
-    """
-    this_week_votes_avg = database.query_r(
-        query, 
-        leaderboards.VotesLeaderboard.MIN_REVIEWS,
-        leaderboards.VotesLeaderboard.MIN_REVIEWS,
-        leaderboards.VotesLeaderboard.MIN_REVIEWS,
-        leaderboards.VotesLeaderboard.MIN_REVIEWS,
-        leaderboards.VotesLeaderboard.MIN_REVIEWS
-    )
-
-    query = """
-        SELECT 
-            group_id,
-            COUNT(vote) AS amount,
-            ROUND(AVG(vote), 1) AS average, 
-            RANK() OVER(PARTITION BY s.lang ORDER BY ROUND(AVG(VOTE), 1)DESC, COUNT(VOTE)DESC)
-        FROM votes
-        LEFT OUTER JOIN supergroups AS s 
-        USING (group_id)
-        WHERE vote_date <= now() - interval %s
-        GROUP BY group_id, s.lang, s.banned_until, s.bot_inside
-        HAVING 
-            (s.banned_until IS NULL OR s.banned_until < now()) 
-            AND COUNT(vote) >= %s 
-            AND s.bot_inside IS TRUE
-    """
-    query = """
-        WITH myconst AS
-        (SELECT 
-            s.lang,
-            AVG(vote)::float AS overall_avg
-        FROM votes AS v
-        LEFT OUTER JOIN supergroups AS s
-        ON s.group_id = v.group_id
-        WHERE (s.banned_until IS NULL OR s.banned_until < now() ) AND vote_date <= now() - interval %s
-        AND s.bot_inside IS TRUE
-        GROUP BY s.lang
-        HAVING COUNT(vote) >= %s)
-
-        SELECT 
-          *,
-          RANK() OVER (PARTITION BY sub.lang  ORDER BY bayesan DESC)
-          FROM (
-            SELECT 
-                v.group_id,
-                s_ref.title, 
-                s_ref.username, 
-                COUNT(vote) AS amount, 
-                ROUND(AVG(vote), 1)::float AS average,
-                s.nsfw,
-                extract(epoch from s.joined_the_bot at time zone 'utc') AS dt,
-                s.lang,
-                s.category,
-                -- (WR) = (v ÷ (v+m)) × R + (m ÷ (v+m)) × C
-                --    * R = average for the movie (mean) = (Rating)
-                --    * v = number of votes for the movie = (votes)
-                --    * m = minimum votes required to be listed in the Top 250 (currently 1300)
-                --    * C = the mean vote across the whole report (currently 6.8)
-                (  (COUNT(vote)::float / (COUNT(vote)+%s)) * AVG(vote)::float + (%s::float / (COUNT(vote)+%s)) * (m.overall_avg) ) AS bayesan
-            FROM votes AS v
-            LEFT OUTER JOIN supergroups_ref AS s_ref
-            ON s_ref.group_id = v.group_id
-            LEFT OUTER JOIN supergroups AS s
-            ON s.group_id = v.group_id
-            LEFT OUTER JOIN myconst AS m
-            ON (s.lang = m.lang)
-            WHERE vote_date <= now() - interval %s
-            GROUP BY v.group_id, s_ref.title, s_ref.username, s.nsfw, s.banned_until, s.lang, s.category, s.bot_inside, s.joined_the_bot, m.overall_avg
-            HAVING 
-                (s.banned_until IS NULL OR s.banned_until < now()) 
-                AND COUNT(vote) >= %s
-                AND s.bot_inside IS TRUE
-          ) AS sub;
-    """
-    last_week_votes_avg = database.query_r(
-        query, 
-        near_interval, 
-        leaderboards.VotesLeaderboard.MIN_REVIEWS,
-        leaderboards.VotesLeaderboard.MIN_REVIEWS,
-        leaderboards.VotesLeaderboard.MIN_REVIEWS,
-        leaderboards.VotesLeaderboard.MIN_REVIEWS,
-        near_interval,
-        leaderboards.VotesLeaderboard.MIN_REVIEWS
-    )
-
-    ##################
-    # ACTIVE USERS
-    ##################
+@run_async
+def weekly_groups_digest(bot, job):
+    # like the private digest, the weeks are fixed by the scheduler: the
+    # one before the run and the one before it
+    new_week = digest_private.previous_week()
+    old_week = new_week - datetime.timedelta(weeks=1)
 
-    query = """
-         SELECT
-            group_id,
-            COUNT(DISTINCT user_id), 
-            RANK() OVER(PARTITION BY s.lang ORDER BY COUNT(DISTINCT user_id) DESC)
-        FROM messages 
-        LEFT OUTER JOIN supergroups AS s 
-        USING (group_id)
-        WHERE 
-            message_date > (now() - interval %s)
-            AND (s.banned_until IS NULL OR s.banned_until < now()) 
-            AND s.bot_inside IS TRUE
-        GROUP BY group_id, s.lang
-        """
-    this_week_active_users = database.query_r(query, near_interval)
+    top_users = get_top_users(new_week, TOP_USERS)
 
-    query = """
-        SELECT 
-            group_id,
-            COUNT(DISTINCT user_id), 
-            RANK() OVER(PARTITION BY s.lang ORDER BY COUNT(DISTINCT user_id) DESC)
-        FROM messages
-        LEFT OUTER JOIN supergroups AS s 
-        USING (group_id)
-        WHERE 
-            message_date BETWEEN (now() - interval %s) AND (now() - interval %s)
-            AND (s.banned_until IS NULL OR s.banned_until < now()) 
-            AND s.bot_inside IS TRUE
-        GROUP BY group_id, s.lang
-        """
-    last_week_active_users = database.query_r(query, far_interval, near_interval)
+    query = DIGEST_QUERY.format(votes_view=leaderboards.VotesLeaderboard.VIEW)
+    rows = database.query_stream(
+            query,
+            new_week,
+            old_week,
+            leaderboards.VotesLeaderboard.MIN_REVIEWS)
 
     start_in = 0
-    for group in lst:
+    for row in rows:
         start_in += 0.1
-        group_id = group[0]
-        lang = group[1]
-
-        msgs_new = 0
-        msgs_old = 0
-        msgs_pos_old = 0
-        msgs_pos_new = 0
-
-        members_new = 0
-        members_old = 0
-        members_pos_old = 0
-        members_pos_new = 0
-
-        sum_v_new = 0
-        avg_v_new = 0
-        sum_v_old = 0
-        avg_v_old = 0
-        avg_pos_old = 0
-        avg_pos_new = 0
-
-        act_users_new = 0
-        act_users_old = 0
-        act_users_pos_old = 0
-        act_users_pos_new = 0
-
-        for i in msgs_this_week:
-            if i[0] == group_id:
-                msgs_new = i[1]
-                msgs_pos_new = i[2]
-                break
-
-        for i in msgs_last_week:
-            if i[0] == group_id:
-                msgs_old = i[1]
-                msgs_pos_old = i[2]
-                break
-
-        for i in members_this_week:
-            if i[0] == group_id:
-                members_new = i[1]
-                members_pos_new = i[2]
-                break
-
-        for i in members_last_week:
-            if i[0] == group_id:
-                members_old = i[1]
-                members_pos_old = i[2]
-                break
-
-        for i in this_week_votes_avg:
-            if i[0] == group_id:
-                sum_v_new = i[3]
-                avg_v_new = i[4]
-                avg_pos_new = i[10]
-                break
-
-        for i in last_week_votes_avg:
-            if i[0] == group_id:
-                sum_v_old = i[3]
-                avg_v_old = i[4]
-                avg_pos_old = i[10]
-                break
-
-        for i in this_week_active_users:
-            if i[0] == group_id:
-                act_users_new = i[1]
-                act_users_pos_new = i[2]
-                break
-
-        for i in last_week_active_users:
-            if i[0] == group_id:
-                act_users_old = i[1]
-                act_users_pos_old = i[2]
-                break
+        group_id = row[0]
+        lang = row[1]
+        (msgs_new, msgs_pos_new, msgs_old, msgs_pos_old,
+         members_new, members_pos_new, members_old, members_pos_old,
+         sum_v_new, avg_v_new, avg_pos_new, sum_v_old, avg_v_old, avg_pos_old,
+         act_users_new, act_users_pos_new, act_users_old, act_users_pos_old) = row[2:]
 
         diff_msg, percent_msg = diff_percent(msgs_new, msgs_old, lang)
         diff_members, percent_members = diff_percent(members_new, members_old, lang) 
@@ -424,21 +293,7 @@ def weekly_groups_digest(bot, job):
         # TOP n USERS
         ##############
 
-        query_top_users = """
-            SELECT 
-                user_id,
-                COUNT(msg_id) AS num_msgs, 
-                name, 
-                RANK() OVER (ORDER BY COUNT(msg_id) DESC)
-            FROM messages AS m
-            LEFT OUTER JOIN users_ref AS u_ref
-            USING (user_id)
-            WHERE group_id = %s AND m.message_date > (now() - interval %s)
-            GROUP BY user_id, name
-            LIMIT %s
-            """
-        top_users_of_the_group = database.query_r(query_top_users, group_id, near_interval, 10)
-        for user in top_users_of_the_group:
+        for user in top_users.get(group_id, []):
             text += "{}) <a href=\"tg://user?id={}\">{}</a>: {}\n".format(
                     user[3],
                     user[0],
@@ -482,5 +337,6 @@ def send_one_by_one_weekly_group_digest(bot, job):
     except Unauthorized:
         query = "UPDATE supergroups SET bot_inside = FALSE WHERE group_id = %s"
         database.query_w(query, group_id)
+        group_settings.invalidate(group_id)
     except Exception as e:
         print("{} exception is send_one_by_one group digest".format(e))
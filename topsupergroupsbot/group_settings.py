@@ -0,0 +1,99 @@
+# TopSupergroupsBot - A telegram bot for telegram public groups leaderboards
+# Copyright (C) 2017-2018  Dario <dariomsn@hotmail.it> (github.com/91DarioDev)
+#
+# TopSupergroupsBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# TopSupergroupsBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TopSupergroupsBot.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+
+from collections import namedtuple
+
+from topsupergroupsbot import config
+from topsupergroupsbot import database
+from topsupergroupsbot import invalidation
+from topsupergroupsbot.lrucache import LRUCache
+
+
+# settings of the supergroups table read by almost any update.
+# the cache is refreshed by the upsert run for every message (see
+# `store`) and dropped in every instance when a setting is changed
+
+GroupSettings = namedtuple('GroupSettings', [
+    'lang',
+    'nsfw',
+    'weekly_digest',
+    'banned_until',
+    'ban_reason',
+    'bot_inside',
+    'category'
+])
+
+# to be used in SELECT and RETURNING, same order of GroupSettings
+COLUMNS = "lang, nsfw, weekly_digest, banned_until, ban_reason, bot_inside, category"
+
+INVALIDATION_NAME = 'group_settings'
+
+_cache = LRUCache(config.GROUP_SETTINGS_CACHE_SIZE, ttl=config.GROUP_SETTINGS_CACHE_TTL)
+
+
+def get(group_id):
+    """
+    returns the GroupSettings of the group or None if the group
+    is not in the database
+    """
+    group_id = int(group_id)
+    settings = _cache.get(group_id)
+    if settings is not None:
+        return settings
+    query = "SELECT {} FROM supergroups WHERE group_id = %s".format(COLUMNS)
+    extract = database.query_r(query, group_id, one=True)
+    if extract is None:
+        return None
+    return store(group_id, extract)
+
+
+def get_lang(group_id):
+    settings = get(group_id)
+    return settings.lang if settings is not None else None
+
+
+def store(group_id, row):
+    """cache a row selected or returned with COLUMNS"""
+    settings = GroupSettings(*row)
+    _cache.set(int(group_id), settings)
+    return settings
+
+
+def invalidate(group_id):
+    """to be called after any UPDATE of the columns of GroupSettings"""
+    invalidation.publish(INVALIDATION_NAME, int(group_id))
+
+
+def banned_until(settings):
+    """returns None if not banned else the expiring date"""
+    if settings is None or settings.banned_until is None:
+        return None
+    if settings.banned_until < datetime.datetime.now():
+        return None
+    return settings.banned_until
+
+
+def stats():
+    return _cache.stats()
+
+
+invalidation.register(
+    INVALIDATION_NAME,
+    lambda key: _cache.pop(int(key)),
+    clear=_cache.clear
+)
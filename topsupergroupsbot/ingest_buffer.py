@@ -0,0 +1,286 @@
+# TopSupergroupsBot - A telegram bot for telegram public groups leaderboards
+# Copyright (C) 2017-2018  Dario <dariomsn@hotmail.it> (github.com/91DarioDev)
+#
+# TopSupergroupsBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# TopSupergroupsBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TopSupergroupsBot.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import time
+import threading
+
+import psycopg2
+
+from topsupergroupsbot import config
+from topsupergroupsbot import database
+from topsupergroupsbot import live_leaderboard
+from topsupergroupsbot import cache_users_stats
+
+from telegram.ext.dispatcher import run_async
+
+
+FLUSH_SIZE = config.INGEST_FLUSH_SIZE
+FLUSH_INTERVAL = config.INGEST_FLUSH_INTERVAL
+MAX_BUFFER = config.INGEST_MAX_BUFFER
+MAX_RETRIES = config.INGEST_MAX_RETRIES
+
+COLUMNS = ('msg_id', 'group_id', 'user_id', 'message_date')
+
+_rows = []
+_rows_lock = threading.Lock()
+# only one flush per time, so rows put back after a failure keep their order
+_flush_lock = threading.Lock()
+
+# (group_id, msg_id) -> expiration of the ids retracted by the antiflood
+# that weren't in the buffer. The id of a message is recorded by the
+# antiflood before the message is buffered: if the retraction runs in
+# between, the message is dropped when it arrives
+RETRACTED_SECONDS = 60
+_retracted = {}
+
+# the counters of the buffer are written under _rows_lock (add_message) and
+# the ones of the flushes under _flush_lock, so no increment is lost.
+# stats() reads them without locks: a snapshot, not always consistent
+_stats = {
+    'flushes': 0,
+    'flushed_rows': 0,
+    'failed_flushes': 0,
+    'consecutive_failures': 0,
+    'dropped_bad_rows': 0,
+    'dropped_buffer_full': 0,
+    'dropped_retracted': 0,
+    'last_flush_rows': 0,
+    'last_flush_seconds': 0.0,
+    'max_flush_seconds': 0.0
+}
+
+
+def add_message(msg_id, group_id, user_id, message_date):
+    """
+    queue a row for the messages table. If the buffer is full it's flushed
+    by the calling thread, unless another flush is already running.
+    """
+    with _rows_lock:
+        if len(_retracted) > 0 and _retracted.pop((group_id, msg_id), 0) > time.time():
+            _stats['dropped_retracted'] += 1
+            return
+        if len(_rows) >= MAX_BUFFER:
+            # the database is failing since long, memory must not grow forever
+            _stats['dropped_buffer_full'] += 1
+            return
+        _rows.append((msg_id, group_id, user_id, message_date))
+        full = len(_rows) >= FLUSH_SIZE
+    if full:
+        flush(wait=False)
+
+
+def flush(wait=True):
+    """
+    write all the buffered rows in the database.
+    returns the amount of written rows
+    """
+    if not _flush_lock.acquire(blocking=wait):
+        return 0
+    try:
+        with _rows_lock:
+            rows = _rows[:]
+            del _rows[:]
+        if len(rows) == 0:
+            return 0
+
+        started_at = time.time()
+        try:
+            try:
+                if _stats['consecutive_failures'] >= MAX_RETRIES:
+                    counts, written = write_rows_isolating(rows)
+                else:
+                    counts, written = write_rows(rows), rows
+            except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+                # a bad row, retrying the same batch would fail forever
+                print("{} in ingest_buffer flush, looking for the bad rows".format(e))
+                counts, written = write_rows_isolating(rows)
+        except Exception as e:
+            # put them back in front of the newer ones, the next flush will retry
+            with _rows_lock:
+                _rows[:0] = rows
+                del _rows[MAX_BUFFER:]
+            _stats['failed_flushes'] += 1
+            _stats['consecutive_failures'] += 1
+            print("{} in ingest_buffer flush ({} rows kept)".format(e, len(rows)))
+            return 0
+        _stats['consecutive_failures'] = 0
+        rows = written
+
+        # committed: a failure here must not write the rows again
+        try:
+            live_leaderboard.add_counts(counts)
+        except Exception as e:
+            print("{} in live leaderboard update".format(e))
+        try:
+            cache_users_stats.mark_dirty(i[2] for i in rows)
+        except Exception as e:
+            print("{} in users stats dirty set".format(e))
+
+        elapsed = time.time() - started_at
+        _stats['flushes'] += 1
+        _stats['flushed_rows'] += len(rows)
+        _stats['last_flush_rows'] = len(rows)
+        _stats['last_flush_seconds'] = elapsed
+        _stats['max_flush_seconds'] = max(_stats['max_flush_seconds'], elapsed)
+        return len(rows)
+    finally:
+        _flush_lock.release()
+
+
+def write_rows(rows):
+    """
+    COPY the rows in a temporary table and move them in messages skipping
+    duplicated primary keys, so a single duplicate can't make the whole
+    batch fail. The rollups are incremented by the inserted rows.
+    Returns the inserted messages counted by (week, group_id, amount)
+    """
+    data = io.StringIO()
+    for row in rows:
+        data.write("\t".join("\\N" if i is None else str(i) for i in row))
+        data.write("\n")
+    data.seek(0)
+
+    with database.transaction() as c:
+        c.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS messages_ingest(
+                msg_id BIGINT,
+                group_id BIGINT,
+                user_id BIGINT,
+                message_date timestamp
+            ) ON COMMIT DELETE ROWS
+        """)
+        c.copy_from(data, 'messages_ingest', columns=COLUMNS)
+        # rollups are updated with the rows really inserted, in the same transaction
+        c.execute("""
+            WITH inserted AS (
+                INSERT INTO messages(msg_id, group_id, user_id, message_date)
+                SELECT msg_id, group_id, user_id, message_date
+                FROM messages_ingest
+                ON CONFLICT DO NOTHING
+                RETURNING msg_id, group_id, user_id, message_date
+            ), by_group AS (
+                SELECT date_trunc('week', message_date)::date AS week, group_id, COUNT(msg_id) AS amount
+                FROM inserted
+                GROUP BY 1, 2
+            ), groups_updated AS (
+                INSERT INTO group_week_counts AS g (week, group_id, amount)
+                SELECT week, group_id, amount
+                FROM by_group
+                ORDER BY 1, 2
+                ON CONFLICT (week, group_id) DO
+                UPDATE SET amount = g.amount + EXCLUDED.amount
+            ), users_updated AS (
+                INSERT INTO user_week_counts AS u (week, group_id, user_id, amount)
+                SELECT date_trunc('week', message_date)::date, group_id, user_id, COUNT(msg_id)
+                FROM inserted
+                GROUP BY 1, 2, 3
+                ORDER BY 1, 2, 3
+                ON CONFLICT (week, group_id, user_id) DO
+                UPDATE SET amount = u.amount + EXCLUDED.amount
+            ), hours_updated AS (
+                INSERT INTO group_hour_counts AS h (hour, group_id, amount)
+                SELECT date_trunc('hour', message_date), group_id, COUNT(msg_id)
+                FROM inserted
+                GROUP BY 1, 2
+                ORDER BY 1, 2
+                ON CONFLICT (hour, group_id) DO
+                UPDATE SET amount = h.amount + EXCLUDED.amount
+            )
+            SELECT week, group_id, amount FROM by_group
+        """)
+        return c.fetchall()
+
+
+def write_rows_isolating(rows):
+    """
+    write the rows in halves until the failing ones are alone, then log
+    and drop them. Returns the counts like write_rows and the written rows.
+    If the database can't be reached it raises: nothing is dropped and the
+    halves already written are skipped as duplicates by the next flush
+    """
+    try:
+        return write_rows(rows), rows
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        raise
+    except Exception as e:
+        if len(rows) == 1:
+            _stats['dropped_bad_rows'] += 1
+            print("{} in ingest_buffer, row dropped: {}".format(e, rows[0]))
+            return [], []
+    half = len(rows) // 2
+    counts_a, written_a = write_rows_isolating(rows[:half])
+    counts_b, written_b = write_rows_isolating(rows[half:])
+    return counts_a + counts_b, written_a + written_b
+
+
+def flush_before_exit():
+    """
+    flush retrying up to MAX_RETRIES times if it fails.
+    Returns (written rows, rows still in the buffer)
+    """
+    written = 0
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt > 0:
+            time.sleep(1)
+        written += flush()
+        if depth() == 0:
+            break
+    return written, depth()
+
+
+def discard(group_id, msg_ids):
+    """
+    remove from the buffer the messages of the group with the given ids.
+    It waits for a running flush, so the messages that are not returned
+    (not found) are committed in the database or not buffered yet: these
+    ones won't be buffered when they arrive.
+    Returns the set of discarded ids
+    """
+    msg_ids = set(msg_ids)
+    with _flush_lock:
+        with _rows_lock:
+            kept = []
+            discarded = set()
+            for row in _rows:
+                if row[1] == group_id and row[0] in msg_ids:
+                    discarded.add(row[0])
+                else:
+                    kept.append(row)
+            _rows[:] = kept
+
+            now = time.time()
+            for key in [k for k, v in _retracted.items() if v <= now]:
+                del _retracted[key]
+            for msg_id in msg_ids - discarded:
+                _retracted[(group_id, msg_id)] = now + RETRACTED_SECONDS
+    return discarded
+
+
+def depth():
+    with _rows_lock:
+        return len(_rows)
+
+
+def stats():
+    dct = dict(_stats)
+    dct['buffer_depth'] = depth()
+    return dct
+
+
+@run_async
+def flush_job(bot, job):
+    flush()
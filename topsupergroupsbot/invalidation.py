@@ -0,0 +1,91 @@
+# TopSupergroupsBot - A telegram bot for telegram public groups leaderboards
+# Copyright (C) 2017-2018  Dario <dariomsn@hotmail.it> (github.com/91DarioDev)
+#
+# TopSupergroupsBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# TopSupergroupsBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TopSupergroupsBot.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import uuid
+import threading
+
+from topsupergroupsbot import database
+
+
+# in-process caches register here a function to drop a key.
+# invalidations are broadcasted with redis pub/sub, so every running
+# instance of the bot (this one included) drops the same key
+
+CHANNEL = 'cache_invalidation'
+RETRY_SECONDS = 5
+
+# messages published by this instance are already handled locally
+INSTANCE_ID = uuid.uuid4().hex
+
+_callbacks = {}
+_clears = []
+_listener = None
+
+
+def register(name, callback, clear=None):
+    """
+    `callback` receives the key as a string.
+    `clear` empties the whole cache, it's called after a lost connection
+    because invalidations could have been missed in the meanwhile
+    """
+    _callbacks[name] = callback
+    if clear is not None:
+        _clears.append(clear)
+
+
+def publish(name, key):
+    # drop it locally first: this instance must not wait the round trip
+    _callbacks[name](str(key))
+    database.REDIS.publish(CHANNEL, "{}:{}:{}".format(INSTANCE_ID, name, key))
+
+
+def handle_message(data):
+    instance_id, name, key = data.decode('UTF-8').split(":", 2)
+    if instance_id == INSTANCE_ID:
+        return
+    try:
+        callback = _callbacks[name]
+    except KeyError:
+        return
+    callback(key)
+
+
+def listen():
+    lost_connection = False
+    while True:
+        try:
+            pubsub = database.REDIS.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CHANNEL)
+            if lost_connection:
+                for clear in _clears:
+                    clear()
+                lost_connection = False
+            for message in pubsub.listen():
+                if message['type'] == 'message':
+                    handle_message(message['data'])
+        except Exception as e:
+            print("{} in invalidation listener".format(e))
+            lost_connection = True
+            time.sleep(RETRY_SECONDS)
+
+
+def start():
+    global _listener
+    if _listener is not None:
+        return
+    _listener = threading.Thread(target=listen, name='cache_invalidation', daemon=True)
+    _listener.start()
@@ -271,10 +271,16 @@ def generic_leaderboard_kb(lang, region):
     messages = InlineKeyboardButton(
                 text=get_lang.get_string(lang, "by_messages"), 
                 callback_data="leaderboard_by:"+leaderboards.Leaderboard.MESSAGES+":"+region)
+    messages_24h = InlineKeyboardButton(
+                text=get_lang.get_string(lang, "by_messages_24h"), 
+                callback_data="leaderboard_by:"+leaderboards.Leaderboard.MESSAGES_24H+":"+region)
+    messages_30d = InlineKeyboardButton(
+                text=get_lang.get_string(lang, "by_messages_30d"), 
+                callback_data="leaderboard_by:"+leaderboards.Leaderboard.MESSAGES_30D+":"+region)
     votes = InlineKeyboardButton(
                 text=get_lang.get_string(lang, "by_votes"), 
                 callback_data="leaderboard_by:"+leaderboards.Leaderboard.VOTES+":"+region)
-    buttons_list = [[members], [messages], [votes]]
+    buttons_list = [[members], [messages], [messages_24h, messages_30d], [votes]]
     keyboard = InlineKeyboardMarkup(buttons_list)
     return keyboard
 
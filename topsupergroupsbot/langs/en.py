@@ -69,6 +69,8 @@ choose_region = (
 
 pre_leadervote = "Ordered by votes average. Having at least {} votes.\nRegion: {}"
 pre_leadermessage = "Ordered by sent messages in this week(UTC).\nRegion: {}"
+pre_leadermessage_24h = "Ordered by sent messages in the last 24 hours.\nRegion: {}"
+pre_leadermessage_30d = "Ordered by sent messages in the last 30 days.\nRegion: {}"
 pre_groupleaderboard = "Top users ordered by messages sent during this week(UTC) in @{}."
 pre_leadermember = "Ordered by amount of members.\nRegion: {}"
 
@@ -93,6 +95,8 @@ generic_leaderboard = (
 
 by_members = "By members"
 by_messages = "By messages"
+by_messages_24h = "Messages 24h"
+by_messages_30d = "Messages 30 days"
 by_votes = "By votes"
 
 
@@ -67,6 +67,8 @@ choose_region = ("Scegli la tua regione. Sarà il filtro di default per la lingu
 
 pre_leadervote = "Ordinati per media voti. Almeno {} voti.\nRegione: {}"
 pre_leadermessage = "Ordinati per numero di messaggi inviati questa settimana(UTC).\nRegione: {}"
+pre_leadermessage_24h = "Ordinati per numero di messaggi inviati nelle ultime 24 ore.\nRegione: {}"
+pre_leadermessage_30d = "Ordinati per numero di messaggi inviati negli ultimi 30 giorni.\nRegione: {}"
 pre_groupleaderboard = "Top utenti ordinati per numero di messaggi inviati durante questa settimana(UTC) in @{}."
 pre_leadermember = "Ordinati per numero di membri.\nRegione: {}"
 
@@ -92,6 +94,8 @@ generic_leaderboard = (
 
 by_members = "Per membri"
 by_messages = "Per messaggi"
+by_messages_24h = "Messaggi 24 ore"
+by_messages_30d = "Messaggi 30 giorni"
 by_votes = "Per voti"
 
 help_message = "Questo bot fa statistiche e classifiche di gruppi pubblici e dei loro utenti."
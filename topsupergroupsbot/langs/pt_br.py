@@ -69,6 +69,8 @@ choose_region = (
 
 pre_leadervote = "Ordenada pela média de votos. Tendo, no mínimo, {} votos.\nRegião: {}"
 pre_leadermessage = "Ordenada pelas mensagens enviadas nesta semana(UTC).\nRegião: {}"
+pre_leadermessage_24h = "Ordenada pelas mensagens enviadas nas últimas 24 horas.\nRegião: {}"
+pre_leadermessage_30d = "Ordenada pelas mensagens enviadas nos últimos 30 dias.\nRegião: {}"
 pre_groupleaderboard = "Principais usuários por quantidade de mensagens enviadas nesta semana (UTC) em @{}."
 pre_leadermember = "Ordenado pela quantidade de membros.\nRegião: {}"
 
@@ -93,6 +95,8 @@ generic_leaderboard = (
 
 by_members = "Por membros"
 by_messages = "Por mensagens"
+by_messages_24h = "Mensagens 24h"
+by_messages_30d = "Mensagens 30 dias"
 by_votes = "Por votos"
 
 
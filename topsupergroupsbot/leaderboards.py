@@ -20,6 +20,7 @@ import time
 import json
 
 from topsupergroupsbot import utils
+from topsupergroupsbot import config
 from topsupergroupsbot import database
 from topsupergroupsbot import constants
 from topsupergroupsbot import get_lang
@@ -27,7 +28,14 @@ from topsupergroupsbot import supported_langs
 from topsupergroupsbot import emojis
 from topsupergroupsbot import keyboards
 from topsupergroupsbot import categories
-from topsupergroupsbot.pages import Pages
+from topsupergroupsbot import group_settings
+from topsupergroupsbot import user_profile
+from topsupergroupsbot import live_leaderboard
+from topsupergroupsbot import singleflight
+from topsupergroupsbot import cache_publish
+from topsupergroupsbot.pages import Pages, RemoteList
+from topsupergroupsbot.lrucache import LRUCache
+from topsupergroupsbot.tiered_cache import TieredCache
 
 from telegram import ParseMode
 from telegram.error import BadRequest
@@ -37,13 +45,36 @@ from telegram.utils.helpers import escape_markdown
 M_C_G = constants.MAX_CHARS_LEADERBOARD_PAGE_GROUP
 M_C_P = constants.MAX_CHARS_LEADERBOARD_PAGE_PRIVATE
 
+# replaced by the age of the list when a rendered page is served
+UPDATED_AGO = "\x00updated_ago\x00"
+
+_rendered_pages = LRUCache(config.LEADERBOARD_PAGES_CACHE_SIZE)
+
+# decoded rows of the cached lists, by (rows key, start, stop). Only pages:
+# whole lists (read to build a category) are not kept in memory
+_rows_cache = TieredCache('Leaderboard rows', config.TIERED_CACHE_SIZE)
+MAX_MEMORY_ROWS = 100
+
+# a cached list older than CACHE_SECONDS*SOFT_TTL_FACTOR is still served
+# while it's refreshed in background, it expires after CACHE_SECONDS*HARD_TTL_FACTOR.
+# The soft ttl is a bit longer than the interval of the scheduled cache
+SOFT_TTL_FACTOR = 1.5
+HARD_TTL_FACTOR = 5
+
 class Leaderboard:
     GROUP = 'igl'  # inside the group
     VOTES = 'vl'
     MESSAGES = 'ml'
+    MESSAGES_24H = 'ml24h'
+    MESSAGES_30D = 'ml30d'
     MEMBERS = 'mml'
 
     NEW_INTERVAL = 60*60*24*7
+    # if set, a rendered page is reused at most for these seconds even if
+    # the generation didn't change (pages of data changing out of the cache)
+    PAGE_MAX_AGE = None
+    # materialized view with the leaderboards of all the regions, if any
+    VIEW = None
 
     def __init__(self, lang=None, region="", page=1, category=None, group_id=None):
         self.lang = lang
@@ -64,113 +95,210 @@ class Leaderboard:
     def cache_key_base(self):
         if self.CODE == GroupLeaderboard.CODE:
             return 'cached_lb:{}:{}'.format(self.CODE, self.group_id)
+        if self.category != "":
+            return 'cached_lb:{}:{}:{}'.format(
+                    self.CODE, 
+                    self.region,
+                    self.category)
         return 'cached_lb:{}:{}'.format(
                 self.CODE, 
                 self.region)
 
+    # a cached list is a small header {"time": .., "count": ..} in
+    # cache_key_base() and a redis list with one compact json row per item,
+    # so a page fetches only its rows with LRANGE
+
+    def rows_key(self):
+        return '{}:rows'.format(self.cache_key_base())
+
     def get_list_from_cache(self):
-        key = self.cache_key_base()
-        lst = database.REDIS.get(key)
-        if lst is None:
+        """returns (list fetching the rows when sliced, cached at) or None"""
+        generation = database.REDIS.get(self.cache_key_base())
+        if generation is None:
+            return None
+        header = json.loads(generation.decode('UTF-8'))
+        if 'count' not in header:  # whole list cached by an older version
             return None
-        lst_and_time = json.loads(lst.decode('UTF-8'))
-        lst = lst_and_time['list']
-        time = lst_and_time['time']
-        return lst, time
+        rows_key = self.rows_key()
 
-    @run_async
-    def cache_the_list(self, lst, doubled_cache_seconds=False):
+        def load(start, stop):
+            rows = database.REDIS.lrange(rows_key, start, stop - 1)
+            return [json.loads(i.decode('UTF-8')) for i in rows]
+
+        def fetch(start, stop):
+            if stop - start > MAX_MEMORY_ROWS:
+                return load(start, stop)
+            # the header changes every time the list is cached
+            return _rows_cache.get((rows_key, start, stop), generation, lambda: load(start, stop))
+
+        return RemoteList(header['count'], fetch), header['time']
+
+    def get_generation(self):
+        """changes every time the list is cached again"""
+        return database.REDIS.get(self.cache_key_base())
+
+    def store_list(self, lst, cached_at=None):
         key = self.cache_key_base()
-        lst_and_time = {'list': lst, 'time': time.time()}
-        dumped_lst = json.dumps(lst_and_time).encode('UTF-8')
-        sec = self.CACHE_SECONDS if doubled_cache_seconds is False else self.CACHE_SECONDS*2
-        database.REDIS.setex(key, dumped_lst, sec)
+        rows_key = self.rows_key()
+        cached_at = time.time() if cached_at is None else cached_at
+        header = json.dumps({'time': cached_at, 'count': len(lst)}).encode('UTF-8')
+        rows = [json.dumps(i, separators=(',', ':')).encode('UTF-8') for i in lst]
+        sec = self.CACHE_SECONDS*HARD_TTL_FACTOR
+        # the header is swapped with the rows: readers never see rows and
+        # header of different lists
+        cache_publish.publish_list(
+                rows_key, rows, sec,
+                on_swap=lambda pipe: pipe.setex(key, header, sec))
+
+    def get_list(self, select):
+        """
+        returns the list of the region (of the category if set) and when it
+        has been cached. `select` is called to select the list of the region
+        from the database if it's not cached. The list of a category is
+        built from the one of the region, with the ranks inside the category.
+        A stale list is returned while it's refreshed in background
+        """
+        lst_and_time = self.get_list_from_cache()
+        if lst_and_time is not None:
+            self.refresh_if_stale(lst_and_time[1], select)
+            return lst_and_time
+        return singleflight.fill(self.cache_key_base(), self.get_list_from_cache, self.list_compute(select))
+
+    def list_compute(self, select):
+        """the function selecting, storing and returning the list and its time"""
+        def compute():
+            if self.category == "":
+                cached_at = self.rows_time()
+                lst = select()
+            else:
+                lst, cached_at = self.__class__(region=self.region).get_list(select)
+                lst = self.category_list(lst[:], self.category)
+            # stored before returning, the callers waiting for it will load it
+            self.store_list(lst, cached_at)
+            return lst, cached_at
+        return compute
+
+    def refresh_if_stale(self, cached_at, select):
+        """refresh in background a list cached at `cached_at` if past the soft ttl"""
+        if time.time() - cached_at > self.CACHE_SECONDS*SOFT_TTL_FACTOR:
+            singleflight.refresh(self.cache_key_base(), self.list_compute(select))
+
+    def category_list(self, lst, category):
+        """the rows of the category ranked again, ties keep sharing the rank"""
+        lst = sorted(
+                (i for i in lst if i[self.INDEX_CATEGORY] == category),
+                key=lambda x: x[self.INDEX_RANK])
+        result = []
+        previous_rank = None
+        for position, row in enumerate(lst, start=1):
+            row = list(row)
+            if row[self.INDEX_RANK] != previous_rank:
+                rank = position
+            previous_rank = row[self.INDEX_RANK]
+            row[self.INDEX_RANK] = rank
+            result.append(row)
+        return result
+
+    def build_page(self):
+        """
+        returns text and reply_markup of the page. The rendered page is
+        kept in memory until the generation of the list changes (or for
+        PAGE_MAX_AGE seconds), only the age of the list is written every time
+        """
+        generation = self.get_generation()
+        key = (self.CODE, self.region, self.category, self.lang, self.page)
+        cached = _rendered_pages.get(key)
+        if (cached is not None and generation is not None and cached[0] == generation
+                and (self.PAGE_MAX_AGE is None or time.time() - cached[1] < self.PAGE_MAX_AGE)):
+            text, reply_markup, cached_at = cached[2:]
+            # the list isn't read: a page served from memory must refresh it too
+            self.refresh_if_stale(cached_at, self.select_region)
+        else:
+            rendered_at = time.time()
+            text, reply_markup, cached_at = self.render_page()
+            # the generation read before rendering: if the list changed
+            # meanwhile the page will be rendered again by the next request
+            if generation is not None:
+                _rendered_pages.set(key, (generation, rendered_at, text, reply_markup, cached_at))
+        updated_ago = utils.round_seconds(max(int(time.time() - cached_at), 1), self.lang, short=True)
+        return text.replace(UPDATED_AGO, updated_ago), reply_markup
+
+    # the leaderboards of all the regions are a materialized view refreshed
+    # by the scheduled cache, a region reads its rows by (lang, rank)
+
+    @classmethod
+    def create_view(cls):
+        database.create_materialized_view(
+                cls.VIEW,
+                cls.view_query(),
+                cls.VIEW_VERSION,
+                unique_columns='group_id',
+                index_columns='lang, rank')
+
+    @classmethod
+    def refreshed_at_key(cls):
+        return 'view_refreshed_at:{}'.format(cls.VIEW)
+
+    @classmethod
+    def refresh_view(cls):
+        """returns the time of the refresh, the one the rows of the view are of"""
+        refreshed_at = time.time()
+        database.query_w("REFRESH MATERIALIZED VIEW CONCURRENTLY {}".format(cls.VIEW))
+        database.REDIS.set(cls.refreshed_at_key(), refreshed_at)
+        return refreshed_at
+
+    @classmethod
+    def view_refreshed_at(cls):
+        """None if unknown (e.g. the view has never been refreshed)"""
+        value = database.REDIS.get(cls.refreshed_at_key())
+        return float(value.decode('UTF-8')) if value is not None else None
+
+    def rows_time(self):
+        """
+        the time the rows selected from the view are of. If the scheduled
+        cache is late the view is refreshed here, otherwise a list cached
+        again would be as old as the one it replaces
+        """
+        if self.VIEW is None:
+            return time.time()
+        refreshed_at = self.view_refreshed_at()
+        if refreshed_at is None or time.time() - refreshed_at > self.CACHE_SECONDS*SOFT_TTL_FACTOR:
+            refreshed_at = self.refresh_view()
+        return refreshed_at
+
+    def select_region(self):
+        query = "SELECT * FROM {} WHERE lang = %s ORDER BY rank".format(self.VIEW)
+        return database.query_r(query, self.region)
+
+    def all_results_no_filters(self):
+        return database.query_r("SELECT * FROM {} ORDER BY lang, rank".format(self.VIEW))
 
     def set_scheduled_cache(self):
+        cached_at = self.refresh_view()
         total = self.all_results_no_filters()
         by_language = utils.split_list_grouping_by_column(total, self.INDEX_LANG)
         for split in by_language:
             lb = self.__class__(region=split)
-            lb.cache_the_list(by_language[split], doubled_cache_seconds=True)
+            lb.store_list(by_language[split], cached_at)
+            # empty categories too, so they are not rebuilt on request
+            for category in categories.CODES:
+                lb = self.__class__(region=split, category=category)
+                lb.store_list(self.category_list(by_language[split], category), cached_at)
+        return total
 
             
 class VotesLeaderboard(Leaderboard):
     CODE = 'vl'
+    VIEW = 'votes_leaderboard'
+    VIEW_VERSION = '2'
     MIN_REVIEWS = 10
     CACHE_SECONDS = 60*3
     INDEX_LANG = 7
     INDEX_CATEGORY = 8
+    INDEX_RANK = 10
 
-    def build_page(self):
-        query = """
-            WITH myconst AS
-            (SELECT 
-                s.lang,
-                AVG(vote)::float AS overall_avg
-            FROM votes AS v
-            LEFT OUTER JOIN supergroups AS s
-            ON s.group_id = v.group_id
-            WHERE (s.banned_until IS NULL OR s.banned_until < now() )
-            AND s.bot_inside IS TRUE
-            GROUP BY s.lang
-            HAVING COUNT(vote) >= %s)
-
-            SELECT 
-              *,
-              RANK() OVER (PARTITION BY sub.lang  ORDER BY bayesan DESC)
-              FROM (
-                SELECT 
-                    v.group_id,
-                    s_ref.title, 
-                    s_ref.username, 
-                    COUNT(vote) AS amount, 
-                    ROUND(AVG(vote), 1)::float AS average,
-                    s.nsfw,
-                    extract(epoch from s.joined_the_bot at time zone 'utc') AS dt,
-                    s.lang,
-                    s.category,
-                    -- (WR) = (v ÷ (v+m)) × R + (m ÷ (v+m)) × C
-                    --    * R = average for the movie (mean) = (Rating)
-                    --    * v = number of votes for the movie = (votes)
-                    --    * m = minimum votes required to be listed in the Top 250 (currently 1300)
-                    --    * C = the mean vote across the whole report (currently 6.8)
-                    (  (COUNT(vote)::float / (COUNT(vote)+%s)) * AVG(vote)::float + (%s::float / (COUNT(vote)+%s)) * (m.overall_avg) ) AS bayesan
-                FROM votes AS v
-                LEFT OUTER JOIN supergroups_ref AS s_ref
-                ON s_ref.group_id = v.group_id
-                LEFT OUTER JOIN supergroups AS s
-                ON s.group_id = v.group_id
-                LEFT OUTER JOIN myconst AS m
-                ON (s.lang = m.lang)
-                GROUP BY v.group_id, s_ref.title, s_ref.username, s.nsfw, s.banned_until, s.lang, s.category, s.bot_inside, s.joined_the_bot, m.overall_avg
-                HAVING 
-                    (s.banned_until IS NULL OR s.banned_until < now()) 
-                    AND COUNT(vote) >= %s
-                    AND s.lang = %s
-                    AND s.bot_inside IS TRUE
-              ) AS sub;
-        """
-
-        lst_and_time = self.get_list_from_cache()
-        if lst_and_time is None:
-            extract = database.query_r(
-                query, 
-                self.MIN_REVIEWS, 
-                self.MIN_REVIEWS, 
-                self.MIN_REVIEWS, 
-                self.MIN_REVIEWS, 
-                self.MIN_REVIEWS, 
-                self.region
-            )
-            self.cache_the_list(extract)
-            cached_sec_ago = 1
-        else:
-            extract, cached_at = lst_and_time
-            cached_sec_ago = int(time.time() - cached_at)
-        updated_ago_string = utils.round_seconds(cached_sec_ago, self.lang, short=True)
-
-        if self.category != "":
-            extract = [i for i in extract if i[self.INDEX_CATEGORY] == self.category]
+    def render_page(self):
+        extract, cached_at = self.get_list(self.select_region)
 
         pages = Pages(extract, self.page)
 
@@ -183,7 +311,7 @@ class VotesLeaderboard(Leaderboard):
             text += "\n{}: {}".format(get_lang.get_string(self.lang, "category"), get_lang.get_string(self.lang, "categories")[categories.CODES[self.category]])
         text += "\n_{}: {}_".format(
             utils.get_lang.get_string(self.lang, "latest_update"),
-            updated_ago_string
+            UPDATED_AGO
         )        
         text += "\n\n"
         for group in pages.chosen_page_items():
@@ -199,32 +327,35 @@ class VotesLeaderboard(Leaderboard):
                     utils.sep_l(group[3], self.lang),
                     new
                     )
-        return text, reply_markup
+        return text, reply_markup, cached_at
 
-    def all_results_no_filters(self):
-        query = """
+    @classmethod
+    def view_query(cls):
+        return """
+            -- running sum and count of the votes of every group, so the
+            -- votes are not scanned again
             WITH myconst AS
             (SELECT 
                 s.lang,
-                AVG(vote)::float AS overall_avg
-            FROM votes AS v
+                SUM(g.votes_sum)::float / SUM(g.votes_count) AS overall_avg
+            FROM group_vote_stats AS g
             LEFT OUTER JOIN supergroups AS s
-            ON s.group_id = v.group_id
+            ON s.group_id = g.group_id
             WHERE (s.banned_until IS NULL OR s.banned_until < now() )
             AND s.bot_inside IS TRUE
             GROUP BY s.lang
-            HAVING COUNT(vote) >= %s)
+            HAVING SUM(g.votes_count) >= {min_reviews})
 
             SELECT 
               *,
-              RANK() OVER (PARTITION BY sub.lang  ORDER BY bayesan DESC)
+              RANK() OVER (PARTITION BY sub.lang  ORDER BY bayesan DESC) AS rank
               FROM (
                 SELECT 
-                    v.group_id,
+                    g.group_id,
                     s_ref.title, 
                     s_ref.username, 
-                    COUNT(vote) AS amount, 
-                    ROUND(AVG(vote), 1)::float AS average,
+                    g.votes_count AS amount, 
+                    ROUND(g.votes_sum::numeric / g.votes_count, 1)::float AS average,
                     s.nsfw,
                     extract(epoch from s.joined_the_bot at time zone 'utc') AS dt,
                     s.lang,
@@ -234,73 +365,46 @@ class VotesLeaderboard(Leaderboard):
                     --    * v = number of votes for the movie = (votes)
                     --    * m = minimum votes required to be listed in the Top 250 (currently 1300)
                     --    * C = the mean vote across the whole report (currently 6.8)
-                    (  (COUNT(vote)::float / (COUNT(vote)+%s)) * AVG(vote)::float + (%s::float / (COUNT(vote)+%s)) * (m.overall_avg) ) AS bayesan
-                FROM votes AS v
+                    (  (g.votes_count::float / (g.votes_count+{min_reviews})) * (g.votes_sum::float / g.votes_count) + ({min_reviews}::float / (g.votes_count+{min_reviews})) * (m.overall_avg) ) AS bayesan
+                FROM group_vote_stats AS g
                 LEFT OUTER JOIN supergroups_ref AS s_ref
-                ON s_ref.group_id = v.group_id
+                ON s_ref.group_id = g.group_id
                 LEFT OUTER JOIN supergroups AS s
-                ON s.group_id = v.group_id
+                ON s.group_id = g.group_id
                 LEFT OUTER JOIN myconst AS m
                 ON (s.lang = m.lang)
-                GROUP BY v.group_id, s_ref.title, s_ref.username, s.nsfw, s.banned_until, s.lang, s.category, s.bot_inside, s.joined_the_bot, m.overall_avg
-                HAVING 
+                WHERE 
                     (s.banned_until IS NULL OR s.banned_until < now()) 
-                    AND COUNT(vote) >= %s
+                    AND g.votes_count >= {min_reviews}
                     AND s.bot_inside IS TRUE
-              ) AS sub;
-        """
-        return database.query_r(
-            query, 
-            self.MIN_REVIEWS, 
-            self.MIN_REVIEWS, 
-            self.MIN_REVIEWS, 
-            self.MIN_REVIEWS, 
-            self.MIN_REVIEWS
-        )
+              ) AS sub
+        """.format(min_reviews=cls.MIN_REVIEWS)
 
 
 class MessagesLeaderboard(Leaderboard):
     CODE = 'ml'
+    VIEW = 'messages_leaderboard'
+    VIEW_VERSION = '1'
     CACHE_SECONDS = 60*3
     INDEX_LANG = 7
     INDEX_CATEGORY = 8
-
-    def build_page(self):
-        query = """
-            SELECT 
-                m.group_id, 
-                COUNT (m.group_id) AS leaderboard,
-                s_ref.title, 
-                s_ref.username,
-                s.nsfw, 
-                extract(epoch from s.joined_the_bot at time zone 'utc') AS dt,
-                RANK() OVER (ORDER BY COUNT(m.group_id) DESC),
-                s.lang,
-                s.category
-            FROM messages AS m
-            LEFT OUTER JOIN supergroups_ref AS s_ref
-            ON s_ref.group_id = m.group_id
-            LEFT OUTER JOIN supergroups AS s
-            ON s.group_id = m.group_id
-            WHERE m.message_date > date_trunc('week', now())
-                AND (s.banned_until IS NULL OR s.banned_until < now()) 
-                AND s.lang = %s
-                AND s.bot_inside IS TRUE
-            GROUP BY m.group_id, s_ref.title, s_ref.username, s.nsfw, dt, s.banned_until, s.lang, s.category, s.bot_inside
-        """
-
-        lst_and_time = self.get_list_from_cache()
-        if lst_and_time is None:
-            extract = database.query_r(query, self.region)
-            self.cache_the_list(extract)
-            cached_sec_ago = 1
+    INDEX_RANK = 6
+    # served from the live sorted sets of the week when they are available.
+    # They change at every flush of the ingest buffer, so a live page is
+    # rendered again after a while instead of at every change
+    LIVE = True
+    PAGE_MAX_AGE = 30
+    PRE_TEXT = "pre_leadermessage"
+
+    def render_page(self):
+        live = live_leaderboard.get_list(self.region, self.category) if self.LIVE else None
+        if live is not None:
+            # only the rows of the page are fetched, already filtered by category
+            extract = RemoteList(*live)
+            updated_at = live_leaderboard.updated_at()
+            cached_at = updated_at if updated_at is not None else time.time()
         else:
-            extract, cached_at = lst_and_time
-            cached_sec_ago = int(time.time() - cached_at)
-        updated_ago_string = utils.round_seconds(cached_sec_ago, self.lang, short=True)    
-
-        if self.category != "":
-            extract = [i for i in extract if i[self.INDEX_CATEGORY] == self.category]
+            extract, cached_at = self.get_list(self.select_region)
 
         pages = Pages(extract, self.page)
         
@@ -308,12 +412,12 @@ class MessagesLeaderboard(Leaderboard):
         reply_markup = pages.build_buttons(base=callback_base, footer_buttons=keyboards.filter_category_button(self.lang, callback_base, pages.chosen_page))
 
         emoji_region = supported_langs.COUNTRY_FLAG[self.region]
-        text = get_lang.get_string(self.lang, "pre_leadermessage").format(emoji_region)
+        text = get_lang.get_string(self.lang, self.PRE_TEXT).format(emoji_region)
         if self.category != "":
             text += "\n{}: {}".format(get_lang.get_string(self.lang, "category"), get_lang.get_string(self.lang, "categories")[categories.CODES[self.category]])
         text += "\n_{}: {}_".format(
             utils.get_lang.get_string(self.lang, "latest_update"),
-            updated_ago_string
+            UPDATED_AGO
         )        
         text += "\n\n"
         for group in pages.chosen_page_items():
@@ -327,81 +431,113 @@ class MessagesLeaderboard(Leaderboard):
                     utils.sep_l(group[1], self.lang), 
                     new
                     )
-        return text, reply_markup
+        return text, reply_markup, cached_at
 
-    def all_results_no_filters(self):
-        query = """
+    @classmethod
+    def view_query(cls):
+        return """
             SELECT 
-                m.group_id, 
-                COUNT (m.group_id) AS leaderboard,
+                g.group_id, 
+                g.amount AS leaderboard,
                 s_ref.title, 
                 s_ref.username,
                 s.nsfw, 
                 extract(epoch from s.joined_the_bot at time zone 'utc') AS dt,
-                RANK() OVER (PARTITION BY s.lang ORDER BY COUNT(m.group_id) DESC),
+                RANK() OVER (PARTITION BY s.lang ORDER BY g.amount DESC) AS rank,
                 s.lang,
                 s.category
-            FROM messages AS m
+            FROM group_week_counts AS g
             LEFT OUTER JOIN supergroups_ref AS s_ref
-            ON s_ref.group_id = m.group_id
+            ON s_ref.group_id = g.group_id
             LEFT OUTER JOIN supergroups AS s
-            ON s.group_id = m.group_id
-            WHERE m.message_date > date_trunc('week', now())
+            ON s.group_id = g.group_id
+            WHERE g.week = date_trunc('week', now())::date
+                AND g.amount > 0
                 AND (s.banned_until IS NULL OR s.banned_until < now()) 
                 AND s.bot_inside IS TRUE
-            GROUP BY m.group_id, s_ref.title, s_ref.username, s.nsfw, dt, s.banned_until, s.lang, s.category, s.bot_inside
-            ORDER BY leaderboard DESC
             """
-        return database.query_r(query)
+
+    def get_generation(self):
+        if not self.LIVE:
+            return super().get_generation()
+        # the live sorted sets of the categories too are rebuilt with the
+        # list of the region, the updates in between are bound by PAGE_MAX_AGE
+        return database.REDIS.get(self.__class__(region=self.region).cache_key_base())
+
+    def set_scheduled_cache(self):
+        total = super().set_scheduled_cache()
+        if self.LIVE:
+            live_leaderboard.reconcile(total)
+        return total
+
+
+class MessagesWindowLeaderboard(MessagesLeaderboard):
+    """
+    messages of a rolling WINDOW, summed from the hourly rollup:
+    the current hour and the ones before it until WINDOW
+    """
+    LIVE = False
+    PAGE_MAX_AGE = None
+    WINDOW = None
+
+    @classmethod
+    def view_query(cls):
+        return """
+            SELECT 
+                g.group_id, 
+                g.amount AS leaderboard,
+                s_ref.title, 
+                s_ref.username,
+                s.nsfw, 
+                extract(epoch from s.joined_the_bot at time zone 'utc') AS dt,
+                RANK() OVER (PARTITION BY s.lang ORDER BY g.amount DESC) AS rank,
+                s.lang,
+                s.category
+            FROM (
+                SELECT group_id, SUM(amount)::int AS amount
+                FROM group_hour_counts
+                WHERE hour > date_trunc('hour', now()) - interval '{window}'
+                GROUP BY group_id
+            ) AS g
+            LEFT OUTER JOIN supergroups_ref AS s_ref
+            ON s_ref.group_id = g.group_id
+            LEFT OUTER JOIN supergroups AS s
+            ON s.group_id = g.group_id
+            WHERE g.amount > 0
+                AND (s.banned_until IS NULL OR s.banned_until < now()) 
+                AND s.bot_inside IS TRUE
+            """.format(window=cls.WINDOW)
+
+
+class Messages24hLeaderboard(MessagesWindowLeaderboard):
+    CODE = 'ml24h'
+    VIEW = 'messages_24h_leaderboard'
+    VIEW_VERSION = '1'
+    WINDOW = '24 hours'
+    CACHE_SECONDS = 60*3
+    PRE_TEXT = "pre_leadermessage_24h"
+
+
+class Messages30dLeaderboard(MessagesWindowLeaderboard):
+    CODE = 'ml30d'
+    VIEW = 'messages_30d_leaderboard'
+    VIEW_VERSION = '1'
+    WINDOW = '30 days'
+    CACHE_SECONDS = 60*10
+    PRE_TEXT = "pre_leadermessage_30d"
 
 
 class MembersLeaderboard(Leaderboard):
     CODE = 'mml'
+    VIEW = 'members_leaderboard'
+    VIEW_VERSION = '2'
     CACHE_SECONDS = 60*10
     INDEX_LANG = 2
     INDEX_CATEGORY = 8
+    INDEX_RANK = 7
 
-    def build_page(self):
-        # Thank https://stackoverflow.com/a/46496407/8372336 to make clear this query
-        query = """
-        SELECT 
-            members.*, 
-            supergroups.lang, 
-            supergroups_ref.title, 
-            supergroups_ref.username, 
-            extract(epoch from supergroups.joined_the_bot at time zone 'utc') AS dt,
-            supergroups.nsfw,
-            RANK() OVER(ORDER BY members.amount DESC),
-            supergroups.category
-        FROM
-        -- Window function to get only de last_date:
-            (SELECT last_members.group_id,last_members.amount
-            FROM
-            (SELECT *, ROW_NUMBER() OVER (PARTITION BY group_id
-            ORDER BY updated_date DESC) AS row FROM members) AS last_members
-            WHERE last_members.row=1) AS members
-        -- Joins with other tables
-        LEFT JOIN supergroups
-        ON members.group_id = supergroups.group_id
-        LEFT JOIN supergroups_ref 
-        ON supergroups.group_id = supergroups_ref.group_id
-        WHERE (supergroups.banned_until IS NULL OR supergroups.banned_until < now()) 
-            AND lang = %s
-            AND supergroups.bot_inside IS TRUE
-        """
-
-        lst_and_time = self.get_list_from_cache()
-        if lst_and_time is None:
-            extract = database.query_r(query, self.region)
-            self.cache_the_list(extract)
-            cached_sec_ago = 1
-        else:
-            extract, cached_at = lst_and_time
-            cached_sec_ago = int(time.time() - cached_at)
-        updated_ago_string = utils.round_seconds(cached_sec_ago, self.lang, short=True)            
-        
-        if self.category != "":
-            extract = [i for i in extract if i[self.INDEX_CATEGORY] == self.category]    
+    def render_page(self):
+        extract, cached_at = self.get_list(self.select_region)
         
         pages = Pages(extract, self.page)
 
@@ -414,7 +550,7 @@ class MembersLeaderboard(Leaderboard):
             text += "\n{}: {}".format(get_lang.get_string(self.lang, "category"), get_lang.get_string(self.lang, "categories")[categories.CODES[self.category]])
         text += "\n_{}: {}_".format(
             utils.get_lang.get_string(self.lang, "latest_update"),
-            updated_ago_string
+            UPDATED_AGO
         )
         text += "\n\n"
         for group in pages.chosen_page_items():
@@ -427,26 +563,24 @@ class MembersLeaderboard(Leaderboard):
                 group[4], 
                 utils.sep_l(group[1], self.lang), 
                 new)
-        return text, reply_markup
+        return text, reply_markup, cached_at
 
-    def all_results_no_filters(self):
-        query = """
+    @classmethod
+    def view_query(cls):
+        return """
             SELECT 
-                members.*, 
+                members.group_id, 
+                members.amount, 
                 supergroups.lang, 
                 supergroups_ref.title, 
                 supergroups_ref.username, 
                 extract(epoch from supergroups.joined_the_bot at time zone 'utc') AS dt,
                 supergroups.nsfw,
-                RANK() OVER (PARTITION BY supergroups.lang ORDER BY members.amount DESC),
-                supergroups.category
-            FROM
-            -- Window function to get only de last_date:
-                (SELECT last_members.group_id,last_members.amount
-                FROM
-                (SELECT *, ROW_NUMBER() OVER (PARTITION BY group_id
-                ORDER BY updated_date DESC) AS row FROM members) AS last_members
-                WHERE last_members.row=1) AS members
+                RANK() OVER (PARTITION BY supergroups.lang ORDER BY members.amount DESC) AS rank,
+                supergroups.category,
+                extract(epoch from members.updated_date at time zone 'utc') AS updated_at
+            -- only the last row of every group
+            FROM members_latest AS members
             -- Joins with other tables
             LEFT JOIN supergroups
             ON members.group_id = supergroups.group_id
@@ -455,7 +589,6 @@ class MembersLeaderboard(Leaderboard):
             WHERE (supergroups.banned_until IS NULL OR supergroups.banned_until < now()) 
                 AND supergroups.bot_inside IS TRUE
             """
-        return database.query_r(query)
 
 
 class GroupLeaderboard(Leaderboard):
@@ -465,28 +598,22 @@ class GroupLeaderboard(Leaderboard):
     def build_page(self, group_username, only_admins=True):
         query = """
             SELECT 
-                m.user_id, 
-                COUNT(m.msg_id) AS leaderboard,
+                c.user_id, 
+                c.amount AS leaderboard,
                 u_ref.name, 
                 u_ref.last_name, 
                 u_ref.username,
-                RANK() OVER (ORDER BY COUNT(m.msg_id) DESC)
-            FROM messages AS m
+                RANK() OVER (ORDER BY c.amount DESC)
+            FROM user_week_counts AS c
             LEFT OUTER JOIN users_ref AS u_ref
             USING (user_id)
-            WHERE m.group_id = %s
-                AND m.message_date > date_trunc('week', now())
-            GROUP BY m.user_id, u_ref.name, u_ref.last_name, u_ref.username
+            WHERE c.week = date_trunc('week', now())::date
+                AND c.group_id = %s
+                AND c.amount > 0
             """
 
-        lst_and_time = self.get_list_from_cache()
-        if lst_and_time is None:
-            extract = database.query_r(query, self.group_id)
-            self.cache_the_list(extract)
-            cached_sec_ago = 1
-        else:
-            extract, cached_at = lst_and_time
-            cached_sec_ago = int(time.time() - cached_at)
+        extract, cached_at = self.get_list(lambda: database.query_r(query, self.group_id))
+        cached_sec_ago = max(int(time.time() - cached_at), 1)
 
         updated_ago_string = utils.round_seconds(cached_sec_ago, self.lang, short=True)
 
@@ -528,9 +655,7 @@ class GroupLeaderboard(Leaderboard):
 @utils.admin_command_only(possible_in_private=True)
 def groupleaderboard(bot, update, args):
     group_id = update.message.chat.id
-    query = "SELECT lang FROM supergroups WHERE group_id = %s"
-    extract = database.query_r(query, group_id, one=True)
-    lang = extract[0]
+    lang = group_settings.get_lang(group_id)
     page = 1
 
     if len(args) == 1:
@@ -630,10 +755,9 @@ def filter_private_leaderboards_params(bot, update, args, lang):
 
 @utils.private_only
 def leadervote(bot, update, args):
-    query = "SELECT lang, region FROM users WHERE user_id = %s"
-    extract = database.query_r(query, update.message.from_user.id, one=True)
-    lang = extract[0]
-    region = extract[1]
+    profile = user_profile.get(update.message.from_user.id)
+    lang = profile.lang
+    region = profile.region
 
     result = filter_private_leaderboards_params(bot, update, args, lang)
     if result is None:
@@ -653,10 +777,9 @@ def leadervote(bot, update, args):
 
 @utils.private_only
 def leadermessage(bot, update, args):
-    query = "SELECT lang, region FROM users WHERE user_id = %s"
-    extract = database.query_r(query, update.message.from_user.id, one=True)
-    lang = extract[0]
-    region = extract[1]
+    profile = user_profile.get(update.message.from_user.id)
+    lang = profile.lang
+    region = profile.region
 
     result = filter_private_leaderboards_params(bot, update, args, lang)
     if result is None:
@@ -676,10 +799,9 @@ def leadermessage(bot, update, args):
 
 @utils.private_only
 def leadermember(bot, update, args):
-    query = "SELECT lang, region FROM users WHERE user_id = %s"
-    extract = database.query_r(query, update.message.from_user.id, one=True)
-    lang = extract[0]
-    region = extract[1]
+    profile = user_profile.get(update.message.from_user.id)
+    lang = profile.lang
+    region = profile.region
 
     result = filter_private_leaderboards_params(bot, update, args, lang)
     if result is None:
@@ -696,6 +818,20 @@ def leadermember(bot, update, args):
             disable_web_page_preview=True)
 
 
+def create_views():
+    for lb in (
+            VotesLeaderboard,
+            MessagesLeaderboard,
+            Messages24hLeaderboard,
+            Messages30dLeaderboard,
+            MembersLeaderboard):
+        lb.create_view()
+
+
+def rendered_pages_stats():
+    return _rendered_pages.stats()
+
+
 @run_async
 def scheduling_votes_leaderboard_cache(bot, job):
     lb = VotesLeaderboard()
@@ -708,6 +844,18 @@ def scheduling_messages_leaderboard_cache(bot, job):
     lb.set_scheduled_cache()
 
 
+@run_async
+def scheduling_messages_24h_leaderboard_cache(bot, job):
+    lb = Messages24hLeaderboard()
+    lb.set_scheduled_cache()
+
+
+@run_async
+def scheduling_messages_30d_leaderboard_cache(bot, job):
+    lb = Messages30dLeaderboard()
+    lb.set_scheduled_cache()
+
+
 @run_async
 def scheduling_members_leaderboard_cache(bot, job):
     lb = MembersLeaderboard()
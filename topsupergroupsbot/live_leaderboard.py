@@ -0,0 +1,231 @@
+# TopSupergroupsBot - A telegram bot for telegram public groups leaderboards
+# Copyright (C) 2017-2018  Dario <dariomsn@hotmail.it> (github.com/91DarioDev)
+#
+# TopSupergroupsBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# TopSupergroupsBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TopSupergroupsBot.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+import json
+import datetime
+
+from topsupergroupsbot import database
+from topsupergroupsbot import group_settings
+from topsupergroupsbot import rollups
+
+
+# live leaderboard by messages of the current week: one sorted set per
+# region (group_id -> messages) and one per region and category.
+# They are incremented when the ingest buffer writes the messages and
+# decremented by the antiflood, so they are always up to date. The
+# scheduled cache of the messages leaderboard rebuilds them from the
+# rollups, that also moves groups that got banned or changed lang/category.
+
+KEY_BASE = 'live_ml'
+META_KEY = 'live_ml_meta'  # group_id -> [title, username, nsfw, dt, lang, category]
+UPDATED_AT_KEY = 'live_ml_updated_at'
+
+# a week plus some margin for the digest
+EXPIRE_SECONDS = 60*60*24*8
+META_EXPIRE_SECONDS = 60*30
+
+# the week is asked to the database, like the rollups do, and kept for a while
+WEEK_CHECK_SECONDS = 60
+_week = [None, 0]
+
+
+def current_week():
+    # same week of date_trunc('week', message_date) of the messages logged now
+    if time.time() - _week[1] > WEEK_CHECK_SECONDS:
+        _week[:] = [rollups.current_week(), time.time()]
+    return _week[0]
+
+
+def week_key(week):
+    if isinstance(week, datetime.date):
+        week = week.isoformat()
+    return week
+
+
+def zset_key(week, region, category=""):
+    if category == "":
+        return "{}:{}:{}".format(KEY_BASE, week_key(week), region)
+    return "{}:{}:{}:{}".format(KEY_BASE, week_key(week), region, category)
+
+
+def listed(settings):
+    """if the group has to be shown in the leaderboards"""
+    return (
+        settings is not None
+        and settings.lang is not None
+        and settings.bot_inside is True
+        and group_settings.banned_until(settings) is None
+    )
+
+
+def add_counts(counts):
+    """counts: iterable of (week, group_id, amount), amount can be negative"""
+    pipe = database.REDIS.pipeline(transaction=False)
+    added = False
+    for week, group_id, amount in counts:
+        settings = group_settings.get(group_id)
+        if not listed(settings):
+            continue
+        keys = [zset_key(week, settings.lang)]
+        if settings.category is not None:
+            keys.append(zset_key(week, settings.lang, settings.category))
+        for key in keys:
+            pipe.zincrby(key, group_id, amount)
+            pipe.expire(key, EXPIRE_SECONDS)
+        added = True
+    if added:
+        pipe.set(UPDATED_AT_KEY, time.time())
+        pipe.execute()
+
+
+def reconcile(rows):
+    """
+    rebuild the sorted sets and the metadata from rows of
+    MessagesLeaderboard.all_results_no_filters. Every key is written in a
+    temporary key and renamed, so readers never see a half written one.
+    Increments of a flush running meanwhile can be lost or counted twice,
+    the next reconciliation fixes them
+    """
+    # the same week of the rows, not the one kept in memory
+    week = rollups.current_week()
+    zsets = {}
+    meta = {}
+    for row in rows:
+        group_id, amount, title, username, nsfw, dt, rank, lang, category = row
+        zsets.setdefault(zset_key(week, lang), {})[group_id] = amount
+        if category is not None:
+            zsets.setdefault(zset_key(week, lang, category), {})[group_id] = amount
+        meta[group_id] = json.dumps([title, username, nsfw, dt, lang, category]).encode('UTF-8')
+
+    pattern = "{}:{}:*".format(KEY_BASE, week_key(week))
+    old_keys = set(i.decode('UTF-8') for i in database.REDIS.scan_iter(match=pattern))
+    pipe = database.REDIS.pipeline(transaction=False)
+    for key, scores in zsets.items():
+        tmp_key = "{}:tmp".format(key)
+        pipe.delete(tmp_key)
+        for group_id, amount in scores.items():
+            pipe.zadd(tmp_key, group_id, amount)
+        pipe.expire(tmp_key, EXPIRE_SECONDS)
+        pipe.rename(tmp_key, key)
+    # regions and categories without groups anymore
+    for key in old_keys - set(zsets):
+        pipe.delete(key)
+    if len(meta) > 0:
+        tmp_key = "{}:tmp".format(META_KEY)
+        pipe.delete(tmp_key)
+        pipe.hmset(tmp_key, meta)
+        pipe.expire(tmp_key, META_EXPIRE_SECONDS)
+        pipe.rename(tmp_key, META_KEY)
+    pipe.set(UPDATED_AT_KEY, time.time())
+    pipe.execute()
+
+
+def get_meta(group_ids):
+    """metadata of the groups, missing ones are selected and stored"""
+    values = database.REDIS.hmget(META_KEY, *group_ids) if len(group_ids) > 0 else []
+    meta = {}
+    missing = []
+    for group_id, value in zip(group_ids, values):
+        if value is None:
+            missing.append(group_id)
+        else:
+            meta[group_id] = json.loads(value.decode('UTF-8'))
+    if len(missing) == 0:
+        return meta
+
+    query = """
+        SELECT 
+            s.group_id,
+            s_ref.title,
+            s_ref.username,
+            s.nsfw,
+            extract(epoch from s.joined_the_bot at time zone 'utc') AS dt,
+            s.lang,
+            s.category
+        FROM supergroups AS s
+        LEFT OUTER JOIN supergroups_ref AS s_ref
+        USING (group_id)
+        WHERE s.group_id = ANY(%s)
+    """
+    extract = database.query_r(query, missing)
+    to_store = {}
+    for row in extract:
+        meta[row[0]] = list(row[1:])
+        to_store[row[0]] = json.dumps(list(row[1:])).encode('UTF-8')
+    if len(to_store) > 0:
+        database.REDIS.hmset(META_KEY, to_store)
+        database.REDIS.expire(META_KEY, META_EXPIRE_SECONDS)
+    return meta
+
+
+class LiveList:
+    """
+    the sorted set as list of rows shaped like the ones of
+    MessagesLeaderboard: [group_id, messages, title, username, nsfw, dt, rank, lang, category].
+    Ranks are like RANK() in sql, groups with the same messages share it
+    """
+    def __init__(self, key):
+        self.key = key
+
+    def __len__(self):
+        return database.REDIS.zcard(self.key)
+
+    def fetch(self, start, stop):
+        items = database.REDIS.zrevrange(self.key, start, stop - 1, withscores=True)
+        if len(items) == 0:
+            return []
+        group_ids = [int(i[0]) for i in items]
+        # groups before the first of the page with more messages
+        rank = database.REDIS.zcount(self.key, "({}".format(items[0][1]), "+inf") + 1
+        meta = get_meta(group_ids)
+        rows = []
+        previous_score = None
+        for position, (group_id, (member, score)) in enumerate(zip(group_ids, items), start=start+1):
+            if previous_score is not None and score != previous_score:
+                rank = position
+            previous_score = score
+            title, username, nsfw, dt, lang, category = meta.get(group_id, [None]*6)
+            rows.append([group_id, int(score), title, username, nsfw, dt, rank, lang, category])
+        return rows
+
+
+def get_list(region, category=""):
+    """
+    returns (length, fetch function) of the current week or None if there
+    is no sorted set for the region (e.g. not rebuilt yet)
+    """
+    week = current_week()
+    live = LiveList(zset_key(week, region, category))
+    length = len(live)
+    if length == 0:
+        return None
+    return length, live.fetch
+
+
+def updated_at():
+    value = database.REDIS.get(UPDATED_AT_KEY)
+    return float(value.decode('UTF-8')) if value is not None else None
+
+
+def rank(region, group_id):
+    """returns (rank, messages) of the group in the current week or None"""
+    key = zset_key(current_week(), region)
+    score = database.REDIS.zscore(key, group_id)
+    if score is None:
+        return None
+    return database.REDIS.zcount(key, "({}".format(score), "+inf") + 1, int(score)
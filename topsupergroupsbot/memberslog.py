@@ -15,6 +15,7 @@
 # along with TopSupergroupsBot.  If not, see <http://www.gnu.org/licenses/>.
 
 from topsupergroupsbot import database
+from topsupergroupsbot import group_settings
 
 from telegram.error import (TelegramError, Unauthorized, BadRequest, TimedOut, 
                             ChatMigrated, NetworkError)
@@ -35,23 +36,10 @@ def members_log(bot, job):
 
 def get_groups_to_log(bot, job):
     query = """
-        WITH m_table AS (
-             SELECT
-                last_members.group_id,
-                last_members.updated_date
-             FROM
-                (
-                SELECT
-                    *,
-                    ROW_NUMBER() OVER (PARTITION BY group_id ORDER BY updated_date DESC) AS row
-                FROM members
-                ) AS last_members 
-            WHERE last_members.row=1
-        )
         SELECT 
             s.group_id
         FROM supergroups AS s
-        LEFT OUTER JOIN m_table AS m
+        LEFT OUTER JOIN members_latest AS m
         USING (group_id)
         WHERE 
             s.bot_inside = TRUE
@@ -78,9 +66,17 @@ def handle_one_by_one(bot, job):
         info = bot.getChat(group_id)
         members = bot.getChatMembersCount(group_id)
 
+        # members_latest keeps the last row of every group
         query = """
-        INSERT INTO members(group_id, amount, updated_date)
-        VALUES(%s, %s, now())
+        WITH logged AS (
+            INSERT INTO members(group_id, amount, updated_date)
+            VALUES(%s, %s, now())
+            RETURNING group_id, amount, updated_date
+        )
+        INSERT INTO members_latest(group_id, amount, updated_date)
+        SELECT group_id, amount, updated_date FROM logged
+        ON CONFLICT (group_id) DO
+        UPDATE SET amount = EXCLUDED.amount, updated_date = EXCLUDED.updated_date
         """
         database.query_w(query, group_id, members)
 
@@ -103,6 +99,7 @@ def handle_one_by_one(bot, job):
         WHERE group_id = %s
         """
         database.query_w(query, group_id)
+        group_settings.invalidate(group_id)
 
     except BadRequest as e:
         if str(e) == "Chat not found":
@@ -112,6 +109,7 @@ def handle_one_by_one(bot, job):
             WHERE group_id = %s
             """
             database.query_w(query, group_id)
+            group_settings.invalidate(group_id)
         else:
             print("{} in memberslog BadRequest: group_id: {}".format(e, group_id))
 
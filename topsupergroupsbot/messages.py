@@ -59,10 +59,8 @@ def before_processing_supergroups(bot, update):
             messages_supergroups.leave_banned_group(bot, update)
             raise DispatcherHandlerStop
 
-    # log stuff on the tables
+    # log stuff on the tables (supergroups, users_ref and supergroups_ref)
     lang = messages_supergroups.add_supergroup_db(bot, update)
-    messages_supergroups.add_user_ref(bot, update)
-    messages_supergroups.add_supergroup_ref(bot, update)
 
     # check if the bot has been added and send a welcome message
     if messages_supergroups.this_bot_has_been_added(bot, update):
@@ -98,15 +96,15 @@ def before_processing_private(bot, update):
 def processing_supergroups(bot, update):
     user_id = update.message.from_user.id
     group_id = update.message.chat.id
-    # check if is flood and handle flood
-    for i in config.FLOOD_CHECKS:
-        af = Antiflood(
-                limit=i, 
-                interval=config.FLOOD_CHECKS[i], 
-                user_id=user_id, 
-                group_id=group_id)
-        if af.is_flood():
-            raise DispatcherHandlerStop
+    # check if is flood and handle flood (all the windows in one redis call)
+    af = Antiflood(
+            checks=config.FLOOD_CHECKS,
+            user_id=user_id,
+            group_id=group_id,
+            msg_id=update.message.message_id,
+            mode=config.FLOOD_MODE)
+    if af.is_flood():
+        raise DispatcherHandlerStop
 
     # log message in the database   
     messages_supergroups.add_message_db(bot, update)
@@ -16,6 +16,7 @@
 
 from topsupergroupsbot import database
 from topsupergroupsbot import utils
+from topsupergroupsbot import user_profile
 
 def add_user_db(bot, update):
     m = update.message
@@ -26,9 +27,11 @@ def add_user_db(bot, update):
     VALUES (%s, %s, %s, %s, %s) 
     ON CONFLICT (user_id) DO 
     UPDATE SET bot_blocked = FALSE, tg_lang = COALESCE(%s, users.tg_lang), message_date = %s 
-        WHERE users.user_id = %s"""
-    database.query_w(
+        WHERE users.user_id = %s
+    RETURNING {}""".format(user_profile.COLUMNS)
+    extract = database.query_wr(
             query, m.from_user.id, guessed_lang, guessed_lang,
             m.from_user.language_code, m.date, m.from_user.language_code,
-            m.date, m.from_user.id)
+            m.date, m.from_user.id, one=True)
+    user_profile.store(m.from_user.id, extract)
 
@@ -15,7 +15,6 @@
 # along with TopSupergroupsBot.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import datetime
 import time
 import html
 
@@ -24,6 +23,9 @@ from topsupergroupsbot import database
 from topsupergroupsbot import constants
 from topsupergroupsbot import get_lang
 from topsupergroupsbot import utils
+from topsupergroupsbot import ingest_buffer
+from topsupergroupsbot import ref_cache
+from topsupergroupsbot import group_settings
 
 import telegram
 
@@ -34,12 +36,11 @@ def leave_unsupported_chat(bot, update):
     if update.message.chat.type == "group" or (
             update.message.chat.type == "supergroup"
             and update.message.chat.username is None):
-        query = "SELECT lang FROM supergroups WHERE group_id = %s"
-        extract = database.query_r(query, update.message.chat.id, one=True)
-        if extract is None:
+        settings = group_settings.get(update.message.chat.id)
+        if settings is None:
             lang = 'en'
         else:
-            lang = extract[0]
+            lang = settings.lang
 
         text = get_lang.get_string(lang, "unsupported_chat")
         text += utils.text_mention_creator(bot, update.message.chat.id)
@@ -47,61 +48,71 @@ def leave_unsupported_chat(bot, update):
         bot.leaveChat(update.message.chat.id)
         query = "UPDATE supergroups SET bot_inside = FALSE WHERE group_id = %s"
         database.query_w(query, update.message.chat.id)
+        group_settings.invalidate(update.message.chat.id)
         return True
 
 # LOG INFO
 
 
 def add_supergroup_db(bot, update):
-    query = """INSERT INTO 
+    """
+    log the group in supergroups, and the user and the group in users_ref and
+    supergroups_ref (only if changed, see ref_cache) with one statement,
+    so a message costs one round trip. Returns the lang of the group
+    """
+    m = update.message
+    write_user_ref = ref_cache.user_must_be_written(m.from_user)
+    write_group_ref = ref_cache.group_must_be_written(m.chat)
+    query = """
+    WITH user_ref AS (
+        INSERT INTO 
+        users_ref(user_id, name, last_name, username, tg_lang, message_date) 
+        SELECT %s, %s, %s, %s, %s, %s
+        WHERE %s
+        ON CONFLICT (user_id) DO 
+        UPDATE SET name = EXCLUDED.name, last_name = EXCLUDED.last_name, 
+            username = EXCLUDED.username, 
+            tg_lang = COALESCE(EXCLUDED.tg_lang, users_ref.tg_lang), 
+            message_date = EXCLUDED.message_date
+    ), group_ref AS (
+        INSERT INTO 
+        supergroups_ref(group_id, title, username, message_date) 
+        SELECT %s, %s, %s, %s
+        WHERE %s
+        ON CONFLICT (group_id) DO 
+        UPDATE SET title = EXCLUDED.title, username = EXCLUDED.username, 
+            message_date = EXCLUDED.message_date
+    )
+    INSERT INTO 
     supergroups(group_id, joined_the_bot, last_date) 
     VALUES (%s, %s, %s) 
     ON CONFLICT (group_id) DO 
-    UPDATE SET last_date = %s, bot_inside = TRUE 
-    WHERE supergroups.group_id = %s
-    RETURNING lang"""
+    UPDATE SET last_date = EXCLUDED.last_date, bot_inside = TRUE 
+    RETURNING {}""".format(group_settings.COLUMNS)
     extract = database.query_wr(
-            query, update.message.chat.id, update.message.date,
-            update.message.date, update.message.date,
-            update.message.chat.id, one=True)
-    return extract[0]
-
-
-def add_user_ref(bot, update):
-    query = """INSERT INTO 
-    users_ref(user_id, name, last_name, username, tg_lang, message_date) 
-    VALUES (%s, %s, %s, %s, %s, %s) 
-    ON CONFLICT (user_id) DO 
-    UPDATE SET name = %s, last_name = %s, username = %s, 
-        tg_lang = COALESCE(%s, users_ref.tg_lang), message_date = %s 
-    WHERE users_ref.user_id = %s"""
-    database.query_w(
-        query, update.message.from_user.id, update.message.from_user.first_name,
-        update.message.from_user.last_name, update.message.from_user.username, 
-        update.message.from_user.language_code, update.message.date, 
-        update.message.from_user.first_name, update.message.from_user.last_name, 
-        update.message.from_user.username, update.message.from_user.language_code, 
-        update.message.date, update.message.from_user.id)
-
-
-def add_supergroup_ref(bot, update):
-    query = """INSERT INTO 
-    supergroups_ref(group_id, title, username, message_date) 
-    VALUES (%s, %s, %s, %s) 
-    ON CONFLICT (group_id) DO 
-    UPDATE SET title = %s, username = %s, message_date = %s 
-    WHERE supergroups_ref.group_id = %s"""
-    database.query_w(
-        query, update.message.chat.id, update.message.chat.title,
-        update.message.chat.username, update.message.date, 
-        update.message.chat.title, update.message.chat.username, 
-        update.message.date, update.message.chat.id)
+            query,
+            # users_ref
+            m.from_user.id, m.from_user.first_name, m.from_user.last_name,
+            m.from_user.username, m.from_user.language_code, m.date,
+            write_user_ref,
+            # supergroups_ref
+            m.chat.id, m.chat.title, m.chat.username, m.date,
+            write_group_ref,
+            # supergroups
+            m.chat.id, m.date, m.date,
+            one=True)
+    if write_user_ref:
+        ref_cache.user_written(m.from_user)
+    if write_group_ref:
+        ref_cache.group_written(m.chat)
+    # the returned row is fresh, no need to select it again later
+    return group_settings.store(m.chat.id, extract).lang
 
 
 def add_message_db(bot, update):
     m = update.message
-    query = "INSERT INTO messages(msg_id, group_id, user_id, message_date) VALUES (%s, %s, %s, %s)"
-    database.query_w(query, m.message_id, m.chat.id, m.from_user.id, m.date)
+    # written in bulk by the ingest buffer
+    ingest_buffer.add_message(m.message_id, m.chat.id, m.from_user.id, m.date)
 
 # THIS GROUP HAS BEEN ADDED
 
@@ -116,24 +127,15 @@ def this_bot_has_been_added(bot, update):
 
 
 def is_banned(bot, update):
-    query = "SELECT banned_until FROM supergroups WHERE group_id = %s"
-    extract = database.query_r(query, update.message.chat.id, one=True)
-    if extract is None:
-        ban = None
-    else:
-        if extract[0] is None or extract[0] < datetime.datetime.now():
-            ban = None
-        else:
-            ban = extract[0]
-    return ban  # this returns None if not banned else the expiring date
+    settings = group_settings.get(update.message.chat.id)
+    return group_settings.banned_until(settings)  # None if not banned else the expiring date
 
 
 def leave_banned_group(bot, update):
-    query_db = "SELECT lang, banned_until, ban_reason FROM supergroups WHERE group_id = %s"
-    extract = database.query_r(query_db, update.message.chat.id, one=True)
-    lang = extract[0]
-    banned_until = extract[1]
-    reason = extract[2]
+    settings = group_settings.get(update.message.chat.id)
+    lang = settings.lang
+    banned_until = settings.banned_until
+    reason = settings.ban_reason
     shown_reason = html.escape(reason) if reason is not None else get_lang.get_string(lang, "not_specified")
     shown_reason = "<code>{}</code>".format(shown_reason)
     text = get_lang.get_string(lang, "banned_until_leave").format(
@@ -143,11 +145,11 @@ def leave_banned_group(bot, update):
     bot.leaveChat(update.message.chat.id)
     query = "UPDATE supergroups SET bot_inside = FALSE WHERE group_id = %s"
     database.query_w(query, update.message.chat.id)
+    group_settings.invalidate(update.message.chat.id)
 
 
 def choose_group_language(bot, update):
-    query_db = "SELECT lang FROM supergroups WHERE group_id = %s"
-    lang = database.query_r(query_db, update.message.chat.id, one=True)[0]
+    lang = group_settings.get_lang(update.message.chat.id)
     text = get_lang.get_string(lang, "choose_group_lang")
     reply_markup = keyboards.select_group_lang_kb(lang, back=False)
     update.message.reply_text(text=text, reply_markup=reply_markup)
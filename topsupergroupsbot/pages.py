@@ -20,6 +20,29 @@ from topsupergroupsbot import keyboards
 from telegram import InlineKeyboardButton
 from telegram import InlineKeyboardMarkup
 
+class RemoteList:
+    """
+    read-only list whose items are fetched only when sliced, so Pages can
+    page through lists stored elsewhere (e.g. a redis sorted set) without
+    downloading them.
+    `fetch(start, stop)` returns the items from start to stop excluded
+    """
+    def __init__(self, length, fetch):
+        self.length = length
+        self.fetch = fetch
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise TypeError("RemoteList supports only slices")
+        start, stop, step = index.indices(self.length)
+        if step != 1 or start >= stop:
+            return []
+        return self.fetch(start, stop)
+
+
 class Pages:
     def __init__(self, lst, chosen_page=1, elements_per_page=10):
         self.elements_per_page = elements_per_page
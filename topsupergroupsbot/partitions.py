@@ -0,0 +1,203 @@
+# TopSupergroupsBot - A telegram bot for telegram public groups leaderboards
+# Copyright (C) 2017-2018  Dario <dariomsn@hotmail.it> (github.com/91DarioDev)
+#
+# TopSupergroupsBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# TopSupergroupsBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TopSupergroupsBot.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import datetime
+
+from topsupergroupsbot import config
+from topsupergroupsbot import database
+from topsupergroupsbot import rollups
+
+from telegram.ext.dispatcher import run_async
+
+
+# weekly range partitions of the tables growing with time. Old rows are
+# removed detaching and dropping whole partitions instead of DELETE.
+# Rows out of the weeks with a partition (a wrong date from telegram, a job
+# not run) go in the DEFAULT partition instead of failing the whole batch
+
+WEEKS_AHEAD = config.PARTITIONS_AHEAD
+
+# table: partition key
+TABLES = {
+    'messages': 'message_date',
+    'members': 'updated_date'
+}
+
+# primary key of the partitioned tables, the partition key is part of it
+PRIMARY_KEYS = {
+    'messages': 'msg_id, group_id, message_date'
+}
+
+PARTITION_DATE_FORMAT = '%Y%m%d'
+
+
+def partition_name(table, week):
+    return "{}_w{}".format(table, week.strftime(PARTITION_DATE_FORMAT))
+
+
+def default_partition_name(table):
+    return "{}_default".format(table)
+
+
+def week_of_partition(table, name):
+    return datetime.datetime.strptime(name[len(table)+2:], PARTITION_DATE_FORMAT).date()
+
+
+def is_partitioned(table):
+    query = "SELECT relkind = 'p' FROM pg_class WHERE relname = %s AND relkind IN ('r', 'p')"
+    extract = database.query_r(query, table, one=True)
+    return extract is not None and extract[0]
+
+
+def list_partitions(table):
+    query = """
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = %s AND child.relname != %s
+        """
+    return sorted(i[0] for i in database.query_r(query, table, default_partition_name(table)))
+
+
+def create_default_partition(c, table):
+    query = "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT".format(
+            default_partition_name(table), table)
+    c.execute(query)
+
+
+def create_partition(c, table, week):
+    name = partition_name(table, week)
+    c.execute("SELECT to_regclass(%s), to_regclass(%s)", (name, default_partition_name(table)))
+    exists, default_exists = c.fetchone()
+    if exists is not None:
+        return
+    bounds = (week, week + datetime.timedelta(weeks=1))
+    if default_exists is None:
+        c.execute("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)".format(name, table), bounds)
+        return
+
+    # postgresql refuses the new partition if the default one has rows of
+    # its range: they are moved out first and then inserted again
+    key = TABLES[table]
+    c.execute("CREATE TEMP TABLE moving_rows (LIKE {}) ON COMMIT DROP".format(table))
+    query = """
+        WITH moved AS (
+            DELETE FROM {} WHERE {} >= %s AND {} < %s RETURNING *
+        )
+        INSERT INTO moving_rows SELECT * FROM moved
+        """.format(default_partition_name(table), key, key)
+    c.execute(query, bounds)
+    c.execute("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)".format(name, table), bounds)
+    c.execute("INSERT INTO {} SELECT * FROM moving_rows".format(table))
+    c.execute("DROP TABLE moving_rows")
+
+
+def create_partitions(table, from_week, to_week):
+    """create the missing partitions, both the weeks included"""
+    with database.transaction() as c:
+        week = from_week
+        while week <= to_week:
+            create_partition(c, table, week)
+            week += datetime.timedelta(weeks=1)
+        create_default_partition(c, table)
+
+
+def create_partitions_ahead():
+    # the previous week too: rows buffered around midnight of monday
+    this_week = rollups.current_week()
+    for table in TABLES:
+        if is_partitioned(table):
+            create_partitions(
+                    table,
+                    this_week - datetime.timedelta(weeks=1),
+                    this_week + datetime.timedelta(weeks=WEEKS_AHEAD))
+
+
+def drop_old_partitions(table, interval):
+    """
+    drop the partitions whose rows are all older than now() - interval.
+    returns the names of the dropped partitions
+    """
+    query = "SELECT (now() - interval %s)::date"
+    older_than = database.query_r(query, interval, one=True)[0]
+    # the default partition is never dropped, its old rows are deleted
+    query = "DELETE FROM {} WHERE {} < now() - interval %s".format(
+            default_partition_name(table), TABLES[table])
+    database.query_w(query, interval)
+    dropped = []
+    for name in list_partitions(table):
+        if week_of_partition(table, name) + datetime.timedelta(weeks=1) > older_than:
+            continue
+        # DETACH locks the parent table until its transaction commits: it's
+        # committed alone, the slow DROP only locks the detached table
+        database.query_w("ALTER TABLE {} DETACH PARTITION {}".format(table, name))
+        database.query_w("DROP TABLE {}".format(name))
+        dropped.append(name)
+    return dropped
+
+
+def migrate(table):
+    """
+    turn an existing unpartitioned table in a partitioned one, copying the rows.
+    Everything is done in one transaction, so it's all or nothing: the table
+    is locked (not even readable) until the whole copy is done. It runs at
+    the start, before polling; other instances of the bot and anything else
+    using the database must be stopped while it runs
+    """
+    key = TABLES[table]
+    old_table = "{}_unpartitioned".format(table)
+    print("migrating {} to a partitioned table, the table is locked until it's done".format(table))
+    with database.transaction() as c:
+        c.execute("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE".format(table))
+        c.execute("SELECT date_trunc('week', MIN({}))::date FROM {}".format(key, table))
+        first_week = c.fetchone()[0]
+        c.execute("ALTER TABLE {} RENAME TO {}".format(table, old_table))
+        query = "CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) PARTITION BY RANGE ({})".format(
+                table, old_table, key)
+        c.execute(query)
+        if table in PRIMARY_KEYS:
+            c.execute("ALTER TABLE {} ADD PRIMARY KEY ({})".format(table, PRIMARY_KEYS[table]))
+
+        c.execute("SELECT date_trunc('week', now())::date")
+        last_week = c.fetchone()[0] + datetime.timedelta(weeks=WEEKS_AHEAD)
+        week = first_week if first_week is not None else last_week
+        while week <= last_week:
+            create_partition(c, table, week)
+            week += datetime.timedelta(weeks=1)
+        create_default_partition(c, table)
+
+        c.execute("INSERT INTO {} SELECT * FROM {}".format(table, old_table))
+        # indexes of the old table go with it, they are created again below
+        c.execute("DROP TABLE {}".format(old_table))
+    print("{} migrated to a partitioned table".format(table))
+
+
+def setup():
+    """to be called at the start, before logging anything"""
+    if not config.PARTITIONING:
+        return
+    for table in TABLES:
+        if not is_partitioned(table):
+            migrate(table)
+    database.create_index()
+    create_partitions_ahead()
+
+
+@run_async
+def create_partitions_job(bot, job):
+    create_partitions_ahead()
@@ -0,0 +1,76 @@
+# TopSupergroupsBot - A telegram bot for telegram public groups leaderboards
+# Copyright (C) 2017-2018  Dario <dariomsn@hotmail.it> (github.com/91DarioDev)
+#
+# TopSupergroupsBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# TopSupergroupsBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TopSupergroupsBot.  If not, see <http://www.gnu.org/licenses/>.
+
+from topsupergroupsbot import config
+from topsupergroupsbot.lrucache import LRUCache
+
+
+# remember the last profile written in users_ref and supergroups_ref, so the
+# upsert runs only if something changed or if the row has not been
+# refreshed for REFRESH_INTERVAL seconds (to keep message_date meaningful)
+
+REFRESH_INTERVAL = config.REF_REFRESH_INTERVAL
+
+USERS = LRUCache(config.REF_CACHE_SIZE, ttl=REFRESH_INTERVAL)
+GROUPS = LRUCache(config.REF_CACHE_SIZE, ttl=REFRESH_INTERVAL)
+
+_stats = {
+    'users_written': 0,
+    'users_skipped': 0,
+    'groups_written': 0,
+    'groups_skipped': 0
+}
+
+
+def user_fingerprint(user):
+    return (user.first_name, user.last_name, user.username, user.language_code)
+
+
+def group_fingerprint(chat):
+    return (chat.title, chat.username)
+
+
+def user_must_be_written(user):
+    if USERS.get(user.id) == user_fingerprint(user):
+        _stats['users_skipped'] += 1
+        return False
+    return True
+
+
+def group_must_be_written(chat):
+    if GROUPS.get(chat.id) == group_fingerprint(chat):
+        _stats['groups_skipped'] += 1
+        return False
+    return True
+
+
+def user_written(user):
+    USERS.set(user.id, user_fingerprint(user))
+    _stats['users_written'] += 1
+
+
+def group_written(chat):
+    GROUPS.set(chat.id, group_fingerprint(chat))
+    _stats['groups_written'] += 1
+
+
+def stats():
+    dct = dict(_stats)
+    for k, v in USERS.stats().items():
+        dct['users_lru_'+k] = v
+    for k, v in GROUPS.stats().items():
+        dct['groups_lru_'+k] = v
+    return dct
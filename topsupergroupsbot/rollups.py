@@ -0,0 +1,112 @@
+# TopSupergroupsBot - A telegram bot for telegram public groups leaderboards
+# Copyright (C) 2017-2018  Dario <dariomsn@hotmail.it> (github.com/91DarioDev)
+#
+# TopSupergroupsBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# TopSupergroupsBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TopSupergroupsBot.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from topsupergroupsbot import database
+
+
+# counters of messages kept updated by the ingest buffer (increments)
+# and by the antiflood (decrements). They can be rebuilt from messages
+# if they ever drift, e.g. after messages have been deleted by hand
+
+def current_week():
+    """the week column of the rollups for now"""
+    return database.query_r("SELECT date_trunc('week', now())::date", one=True)[0]
+
+def rebuild_group_week_counts():
+    """returns the amount of rebuilt rows"""
+    with database.transaction() as c:
+        # flushes running in other transactions wait for the rebuild: the
+        # ones already committed are counted by the SELECT, the others will
+        # increment the new rows
+        c.execute("LOCK TABLE group_week_counts IN EXCLUSIVE MODE")
+        c.execute("DELETE FROM group_week_counts")
+        c.execute("""
+            INSERT INTO group_week_counts(week, group_id, amount)
+            SELECT date_trunc('week', message_date)::date, group_id, COUNT(msg_id)
+            FROM messages
+            GROUP BY 1, 2
+        """)
+        return c.rowcount
+
+
+def rebuild_user_week_counts():
+    """returns the amount of rebuilt rows"""
+    with database.transaction() as c:
+        c.execute("LOCK TABLE user_week_counts IN EXCLUSIVE MODE")
+        c.execute("DELETE FROM user_week_counts")
+        c.execute("""
+            INSERT INTO user_week_counts(week, group_id, user_id, amount)
+            SELECT date_trunc('week', message_date)::date, group_id, user_id, COUNT(msg_id)
+            FROM messages
+            GROUP BY 1, 2, 3
+        """)
+        return c.rowcount
+
+
+def rebuild_group_hour_counts():
+    """returns the amount of rebuilt rows"""
+    with database.transaction() as c:
+        c.execute("LOCK TABLE group_hour_counts IN EXCLUSIVE MODE")
+        c.execute("DELETE FROM group_hour_counts")
+        c.execute("""
+            INSERT INTO group_hour_counts(hour, group_id, amount)
+            SELECT date_trunc('hour', message_date), group_id, COUNT(msg_id)
+            FROM messages
+            GROUP BY 1, 2
+        """)
+        return c.rowcount
+
+
+def rebuild_group_vote_stats():
+    """returns the amount of rebuilt rows"""
+    with database.transaction() as c:
+        # votes being written in other transactions wait here before
+        # applying their difference to the new rows
+        c.execute("LOCK TABLE group_vote_stats IN EXCLUSIVE MODE")
+        c.execute("DELETE FROM group_vote_stats")
+        c.execute("""
+            INSERT INTO group_vote_stats(group_id, votes_sum, votes_count)
+            SELECT group_id, SUM(vote), COUNT(vote)
+            FROM votes
+            GROUP BY group_id
+        """)
+        return c.rowcount
+
+
+def rebuild_members_latest():
+    """returns the amount of rebuilt rows"""
+    with database.transaction() as c:
+        c.execute("LOCK TABLE members_latest IN EXCLUSIVE MODE")
+        c.execute("DELETE FROM members_latest")
+        c.execute("""
+            INSERT INTO members_latest(group_id, amount, updated_date)
+            SELECT DISTINCT ON (group_id) group_id, amount, updated_date
+            FROM members
+            ORDER BY group_id, updated_date DESC
+        """)
+        return c.rowcount
+
+
+def rebuild_all():
+    """returns a dict with the amount of rebuilt rows of every rollup"""
+    return {
+        'group_week_counts': rebuild_group_week_counts(),
+        'user_week_counts': rebuild_user_week_counts(),
+        'group_hour_counts': rebuild_group_hour_counts(),
+        'group_vote_stats': rebuild_group_vote_stats(),
+        'members_latest': rebuild_members_latest()
+    }
@@ -0,0 +1,169 @@
+# TopSupergroupsBot - A telegram bot for telegram public groups leaderboards
+# Copyright (C) 2017-2018  Dario <dariomsn@hotmail.it> (github.com/91DarioDev)
+#
+# TopSupergroupsBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# TopSupergroupsBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TopSupergroupsBot.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+import uuid
+import threading
+
+from topsupergroupsbot import database
+
+from telegram.ext.dispatcher import run_async
+
+
+# single-flight fill of the caches: when a key is missing only one caller
+# computes it, in this process (a lock per key) and among all the
+# instances (a redis lock). The others wait for the value to be stored.
+# Stale values are served while `refresh` computes them in background.
+
+LOCK_SECONDS = 60
+WAIT_SECONDS = 15
+POLL_SECONDS = 0.1
+
+LOCK_KEY = 'singleflight:{}'
+
+# delete the lock only if still owned, it could have expired meanwhile
+RELEASE_SCRIPT = database.REDIS.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+_locks = {}
+_locks_lock = threading.Lock()
+_refreshing = set()
+
+_stats = {
+    'fills': 0,
+    'refreshes': 0,
+    'waited': 0,
+    'waited_and_found': 0,
+    'gave_up_waiting': 0
+}
+
+
+def _local_lock(key):
+    with _locks_lock:
+        try:
+            lock, users = _locks[key]
+        except KeyError:
+            lock, users = threading.Lock(), 0
+        _locks[key] = (lock, users + 1)
+        return lock
+
+
+def _local_lock_done(key):
+    with _locks_lock:
+        lock, users = _locks[key]
+        if users == 1:
+            del _locks[key]
+        else:
+            _locks[key] = (lock, users - 1)
+
+
+def fill(key, load, compute):
+    """
+    `load()` returns the cached value or None if missing.
+    `compute()` computes the value, stores it where `load` reads it and
+    returns it. Returns the value loaded or computed
+    """
+    value = load()
+    if value is not None:
+        return value
+
+    lock = _local_lock(key)
+    try:
+        locked = lock.acquire(timeout=WAIT_SECONDS)
+        try:
+            # filled by the thread holding the lock before
+            value = load()
+            if value is not None:
+                return value
+            return _fill_among_instances(key, load, compute)
+        finally:
+            if locked:
+                lock.release()
+    finally:
+        _local_lock_done(key)
+
+
+def _fill_among_instances(key, load, compute):
+    lock_key = LOCK_KEY.format(key)
+    token = uuid.uuid4().hex
+    if database.REDIS.set(lock_key, token, nx=True, ex=LOCK_SECONDS):
+        try:
+            _stats['fills'] += 1
+            return compute()
+        finally:
+            RELEASE_SCRIPT(keys=[lock_key], args=[token])
+
+    # another instance is computing it
+    _stats['waited'] += 1
+    deadline = time.time() + WAIT_SECONDS
+    while time.time() < deadline:
+        time.sleep(POLL_SECONDS)
+        value = load()
+        if value is not None:
+            _stats['waited_and_found'] += 1
+            return value
+        if not database.REDIS.exists(lock_key):
+            break
+    value = load()
+    if value is not None:
+        _stats['waited_and_found'] += 1
+        return value
+    # the other instance failed or is too slow
+    _stats['gave_up_waiting'] += 1
+    return compute()
+
+
+def refresh(key, compute):
+    """
+    run `compute` in background to replace a stale value, unless it's
+    already computed by this or another instance
+    """
+    with _locks_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+    _refresh(key, compute)
+
+
+# in the worker pool of the dispatcher, like the other background tasks
+@run_async
+def _refresh(key, compute):
+    lock_key = LOCK_KEY.format(key)
+    token = uuid.uuid4().hex
+    try:
+        if not database.REDIS.set(lock_key, token, nx=True, ex=LOCK_SECONDS):
+            return
+        try:
+            _stats['refreshes'] += 1
+            compute()
+        finally:
+            RELEASE_SCRIPT(keys=[lock_key], args=[token])
+    except Exception as e:
+        print("{} refreshing {}".format(e, key))
+    finally:
+        with _locks_lock:
+            _refreshing.discard(key)
+
+
+def stats():
+    dct = dict(_stats)
+    dct['keys_in_flight'] = len(_locks)
+    return dct
@@ -0,0 +1,86 @@
+# TopSupergroupsBot - A telegram bot for telegram public groups leaderboards
+# Copyright (C) 2017-2018  Dario <dariomsn@hotmail.it> (github.com/91DarioDev)
+#
+# TopSupergroupsBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# TopSupergroupsBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TopSupergroupsBot.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+
+from topsupergroupsbot.lrucache import LRUCache
+
+
+# in-process copies of values decoded from redis, in front of it. Every
+# copy is tagged with the generation of the redis data it comes from (the
+# header or the update time written with the data): the caller reads the
+# current generation from redis, a small value, and the copy is used only
+# if it's the same, so it's never older than redis.
+# The same object is returned to every caller: it must not be modified
+
+_caches = []
+
+
+class TieredCache:
+    def __init__(self, name, maxsize):
+        self.name = name
+        self._local = LRUCache(maxsize)
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        _caches.append(self)
+
+    def get(self, key, generation, load):
+        """
+        returns the value of key for the current redis `generation`, None
+        if redis has no data (generation is None). `load()` reads and
+        decodes the value from redis when the local copy is missing or
+        of another generation, it returns None if the value is missing
+        """
+        if generation is None:
+            self._count('misses')
+            return None
+        cached = self._local.get(key)
+        if cached is not None and cached[0] == generation:
+            self._count('local_hits')
+            return cached[1]
+        value = load()
+        self._count('misses' if value is None else 'redis_hits')
+        # missing values too, they are missing for the whole generation
+        self._local.set(key, (generation, value))
+        return value
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def clear(self):
+        self._local.clear()
+
+    def stats(self):
+        requests = self.local_hits + self.redis_hits + self.misses
+        redis_requests = self.redis_hits + self.misses
+        return {
+            'size': len(self._local),
+            'evictions': self._local.evictions,
+            'local_hits': self.local_hits,
+            'redis_hits': self.redis_hits,
+            'misses': self.misses,
+            'local_hit_ratio': self.local_hits / requests if requests else 0.0,
+            'redis_hit_ratio': self.redis_hits / redis_requests if redis_requests else 0.0
+        }
+
+
+def stats():
+    """returns {name: stats} of all the tiered caches"""
+    return {i.name: i.stats() for i in _caches}
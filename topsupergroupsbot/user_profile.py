@@ -0,0 +1,86 @@
+# TopSupergroupsBot - A telegram bot for telegram public groups leaderboards
+# Copyright (C) 2017-2018  Dario <dariomsn@hotmail.it> (github.com/91DarioDev)
+#
+# TopSupergroupsBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# TopSupergroupsBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TopSupergroupsBot.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import namedtuple
+
+from topsupergroupsbot import config
+from topsupergroupsbot import database
+from topsupergroupsbot import invalidation
+from topsupergroupsbot.lrucache import LRUCache
+
+
+# private settings of the users. Any query writing these columns returns
+# them with RETURNING COLUMNS and passes the row to `store` (private
+# messages) or `update` (settings changed), so reads rarely hit the db
+
+UserProfile = namedtuple('UserProfile', [
+    'lang',
+    'region',
+    'weekly_own_digest',
+    'weekly_groups_digest'
+])
+
+# to be used in SELECT and RETURNING, same order of UserProfile
+COLUMNS = "lang, region, weekly_own_digest, weekly_groups_digest"
+
+INVALIDATION_NAME = 'user_profile'
+
+_cache = LRUCache(config.USER_PROFILE_CACHE_SIZE, ttl=config.USER_PROFILE_CACHE_TTL)
+
+
+def get(user_id):
+    """returns the UserProfile or None if the user is not in the database"""
+    user_id = int(user_id)
+    profile = _cache.get(user_id)
+    if profile is not None:
+        return profile
+    query = "SELECT {} FROM users WHERE user_id = %s".format(COLUMNS)
+    extract = database.query_r(query, user_id, one=True)
+    if extract is None:
+        return None
+    return store(user_id, extract)
+
+
+def get_lang(user_id):
+    profile = get(user_id)
+    return profile.lang if profile is not None else 'en'
+
+
+def store(user_id, row):
+    """cache a row selected or returned with COLUMNS"""
+    profile = UserProfile(*row)
+    _cache.set(int(user_id), profile)
+    return profile
+
+
+def update(user_id, row):
+    """
+    like `store`, but the other instances of the bot are told to drop
+    their copy. To be used when the user changes a setting
+    """
+    invalidation.publish(INVALIDATION_NAME, int(user_id))
+    return store(user_id, row)
+
+
+def stats():
+    return _cache.stats()
+
+
+invalidation.register(
+    INVALIDATION_NAME,
+    lambda key: _cache.pop(int(key)),
+    clear=_cache.clear
+)
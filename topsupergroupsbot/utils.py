@@ -25,6 +25,7 @@ from topsupergroupsbot import constants
 from topsupergroupsbot import get_lang
 from topsupergroupsbot import database
 from topsupergroupsbot import config
+from topsupergroupsbot import user_profile
 
 from telegram import constants as ptb_consts
 
@@ -41,10 +42,7 @@ from telegram.error import (
 
 
 def get_db_lang(user_id):
-    query = "SELECT lang FROM users WHERE user_id = %s"
-    extract = database.query_r(query, user_id, one=True)
-    lang = extract[0] if extract is not None else 'en'
-    return lang
+    return user_profile.get_lang(user_id)
 
 
 def bot_owner_only(func):